@@ -3,6 +3,8 @@
 OAuth access_token (sk-ant-oat01-...) живёт 8 часов.
 Refresh token (sk-ant-ort01-...) — неограниченно.
 При 401 OAuthRefresher обновляет access_token через refresh_token.
+После первого refresh срок жизни известен (expires_in) — фоновая задача
+обновляет токен заранее, за REFRESH_MARGIN до истечения.
 """
 
 from __future__ import annotations
@@ -10,6 +12,7 @@ from __future__ import annotations
 import asyncio
 import logging
 import os
+import tempfile
 from pathlib import Path
 
 import httpx
@@ -25,6 +28,17 @@ CLAUDE_CODE_CLIENT_ID = (
 )
 
 ENV_PATH = Path(__file__).resolve().parent.parent.parent / ".env"
+_TOKEN_LINE_PREFIXES = ("ANTHROPIC_AUTH_TOKEN=", "ANTHROPIC_REFRESH_TOKEN=")
+
+# Запас до истечения access_token, за который обновляем его заранее (сек)
+REFRESH_MARGIN = 300
+# Срок жизни access_token, если ответ не содержит expires_in (8 часов)
+DEFAULT_EXPIRES_IN = 28800
+# Как часто фоновая задача перепроверяет срок, пока он неизвестен (сек)
+_UNKNOWN_EXPIRY_CHECK_INTERVAL = 600
+
+# Refresh — редкая операция одного клиента: держим одно keep-alive соединение
+_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=1, max_connections=2)
 
 
 class OAuthRefreshError(Exception):
@@ -32,19 +46,105 @@ class OAuthRefreshError(Exception):
 
 
 class OAuthRefresher:
-    """Обновляет OAuth access_token через refresh_token при 401."""
+    """Обновляет OAuth access_token через refresh_token при 401.
+
+    refresh_token одноразовый: два refresher'а с собственными lock'ами
+    отправили бы его параллельно (refresh_token_reused). Поэтому экземпляр
+    один на процесс — его создаёт AgentCore.
+    """
 
     def __init__(self, settings: Settings) -> None:
         self._settings = settings
+        # Lock у экземпляра, а не у класса: lock уровня модуля был бы общим
+        # для всех event loop'ов процесса (тесты, повторный asyncio.run)
         self._lock = asyncio.Lock()
+        self._client: httpx.AsyncClient | None = None
+        # loop.time(), после которого токен нужно обновить (None — срок неизвестен)
+        self._expires_at: float | None = None
+        self._task: asyncio.Task | None = None
+        # Кеш строк .env (см. _read_env_lines)
+        self._env_cache: list[str] | None = None
+        self._env_mtime_ns: int | None = None
+        # Последние записанные в .env (access_token, refresh_token)
+        self._last_written: tuple[str, str] | None = None
+
+    def needs_refresh(self) -> bool:
+        """Истекает ли текущий access_token (с учётом REFRESH_MARGIN)."""
+        if self._expires_at is None:
+            return False
+        return asyncio.get_running_loop().time() >= self._expires_at
+
+    async def get_token(self) -> str:
+        """Актуальный access_token: обновляет заранее, если срок подходит к концу."""
+        token = self._settings.anthropic_auth_token
+        if self.needs_refresh():
+            return await self.refresh(token)
+        return token
+
+    def start(self) -> None:
+        """Запустить фоновое упреждающее обновление токена."""
+        if self._task and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._loop())
+        logger.info("Фоновый refresh OAuth токена запущен")
+
+    async def _loop(self) -> None:
+        """Спать до момента упреждающего refresh, затем обновить токен."""
+        loop = asyncio.get_running_loop()
+        while True:
+            if self._expires_at is None:
+                delay = _UNKNOWN_EXPIRY_CHECK_INTERVAL
+            else:
+                delay = max(0.0, self._expires_at - loop.time())
+            await asyncio.sleep(delay)
+            if not self.needs_refresh():
+                continue
+            try:
+                await self.refresh(self._settings.anthropic_auth_token)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Не валим цикл: следующий 401 обновит токен синхронно
+                logger.exception("Упреждающий refresh OAuth токена не удался")
+                await asyncio.sleep(60)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Общий HTTP-клиент (создаётся лениво, переиспользует TCP+TLS соединение).
+
+        Вызывается под self._lock из refresh(), между проверкой и созданием
+        нет await — повторная блокировка не нужна.
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=30.0, limits=_HTTP_LIMITS)
+        return self._client
 
-    async def refresh(self) -> str:
+    async def aclose(self) -> None:
+        """Остановить фоновый refresh и закрыть HTTP-клиент (вызывается при shutdown)."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def refresh(self, stale_token: str) -> str:
         """Обновить access_token. Возвращает новый токен.
 
-        asyncio.Lock гарантирует что при конкурентных 401
-        только один запрос делает refresh.
+        stale_token — токен, с которым вызывающий получил 401 (или который
+        истекает). asyncio.Lock + повторная проверка под lock гарантируют,
+        что при конкурентных 401 refresh делает только первый запрос,
+        остальные получают уже обновлённый токен (refresh_token одноразовый).
         """
         async with self._lock:
+            current = self._settings.anthropic_auth_token
+            if current and current != stale_token:
+                logger.debug("Токен уже обновлён другим запросом")
+                return current
+
             refresh_token = self._settings.anthropic_refresh_token
             if not refresh_token:
                 raise OAuthRefreshError(
@@ -54,17 +154,17 @@ class OAuthRefresher:
 
             logger.info("Обновляем OAuth access_token через refresh_token...")
             try:
-                async with httpx.AsyncClient(timeout=30.0) as http:
-                    resp = await http.post(
-                        TOKEN_ENDPOINT,
-                        json={
-                            "grant_type": "refresh_token",
-                            "client_id": CLAUDE_CODE_CLIENT_ID,
-                            "refresh_token": refresh_token,
-                        },
-                    )
-                    resp.raise_for_status()
-                    data = resp.json()
+                http = self._get_client()
+                resp = await http.post(
+                    TOKEN_ENDPOINT,
+                    json={
+                        "grant_type": "refresh_token",
+                        "client_id": CLAUDE_CODE_CLIENT_ID,
+                        "refresh_token": refresh_token,
+                    },
+                )
+                resp.raise_for_status()
+                data = resp.json()
             except httpx.HTTPStatusError as e:
                 logger.error("Ошибка refresh: HTTP %d — %s", e.response.status_code, e.response.text)
                 raise OAuthRefreshError(f"HTTP {e.response.status_code}: {e.response.text}") from e
@@ -78,6 +178,11 @@ class OAuthRefresher:
             if not new_access:
                 raise OAuthRefreshError("Ответ не содержит access_token")
 
+            expires_in = data.get("expires_in") or DEFAULT_EXPIRES_IN
+            self._expires_at = (
+                asyncio.get_running_loop().time() + max(0, expires_in - REFRESH_MARGIN)
+            )
+
             # Обновляем in-memory
             self._settings.anthropic_auth_token = new_access
             if new_refresh:
@@ -91,31 +196,63 @@ class OAuthRefresher:
             # Персистим в .env (переживёт рестарт контейнера)
             self._save_tokens_to_env(new_access, new_refresh or refresh_token)
 
-            logger.info("OAuth access_token обновлён успешно")
+            logger.info("OAuth access_token обновлён успешно (истекает через %d сек)", expires_in)
             return new_access
 
-    @staticmethod
-    def _save_tokens_to_env(access_token: str, refresh_token: str) -> None:
-        """Атомарно обновить токены в .env файле."""
-        lines: list[str] = []
+    def _read_env_lines(self) -> list[str]:
+        """Строки .env из кеша; файл перечитывается только если изменился (mtime).
+
+        .env также пишут auth-хендлеры (/authslack, /authtelegram), поэтому
+        кеш сверяется с mtime, а не считается вечным.
+        """
+        try:
+            mtime_ns = ENV_PATH.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._env_cache, self._env_mtime_ns = [], None
+            return self._env_cache
+        if self._env_cache is None or mtime_ns != self._env_mtime_ns:
+            self._env_cache = ENV_PATH.read_text().splitlines()
+            self._env_mtime_ns = mtime_ns
+        return self._env_cache
+
+    def _save_tokens_to_env(self, access_token: str, refresh_token: str) -> None:
+        """Атомарно обновить токены в .env файле (tmp + os.replace).
+
+        Если токены совпадают с последними записанными — файл не трогаем.
+        """
+        if self._last_written == (access_token, refresh_token):
+            logger.debug("Токены не изменились, запись .env пропущена")
+            return
+        lines = list(self._read_env_lines())
         access_saved = False
         refresh_saved = False
 
-        if ENV_PATH.exists():
-            for line in ENV_PATH.read_text().splitlines():
-                if line.startswith("ANTHROPIC_AUTH_TOKEN="):
-                    lines.append(f"ANTHROPIC_AUTH_TOKEN={access_token}")
-                    access_saved = True
-                elif line.startswith("ANTHROPIC_REFRESH_TOKEN="):
-                    lines.append(f"ANTHROPIC_REFRESH_TOKEN={refresh_token}")
-                    refresh_saved = True
-                else:
-                    lines.append(line)
+        for i, line in enumerate(lines):
+            # Одна проверка на строку; различаем ключ только для строк с токенами
+            if not line.startswith(_TOKEN_LINE_PREFIXES):
+                continue
+            if line.startswith("ANTHROPIC_AUTH_TOKEN="):
+                lines[i] = f"ANTHROPIC_AUTH_TOKEN={access_token}"
+                access_saved = True
+            else:
+                lines[i] = f"ANTHROPIC_REFRESH_TOKEN={refresh_token}"
+                refresh_saved = True
 
         if not access_saved:
             lines.append(f"ANTHROPIC_AUTH_TOKEN={access_token}")
         if not refresh_saved:
             lines.append(f"ANTHROPIC_REFRESH_TOKEN={refresh_token}")
 
-        ENV_PATH.write_text("\n".join(lines) + "\n")
+        fd, tmp_path = tempfile.mkstemp(dir=ENV_PATH.parent, suffix=".tmp", prefix=".env_")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, ENV_PATH)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        self._env_cache = lines
+        self._env_mtime_ns = ENV_PATH.stat().st_mtime_ns
+        self._last_written = (access_token, refresh_token)
         logger.debug("Токены сохранены в %s", ENV_PATH)
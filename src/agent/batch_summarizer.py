@@ -0,0 +1,146 @@
+"""Фоновое сжатие истории через Message Batches API (на 50% дешевле).
+
+maybe_summarize ставит задачу в очередь (таблица summary_jobs) и не ждёт
+ответа; фоновый цикл раз в BATCH_POLL_INTERVAL отправляет накопленные
+задачи одним batch и забирает готовые резюме в conversation_summaries.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections.abc import Callable
+
+import anthropic
+
+from src.agent.summarizer import save_summary, summary_request_params
+from src.db.database import Database
+
+logger = logging.getLogger(__name__)
+
+# Как часто отправлять очередь и проверять статус отправленных batch (сек)
+BATCH_POLL_INTERVAL = 60.0
+
+_CUSTOM_ID_PREFIX = "summary-"
+
+
+class BatchSummarizer:
+    """Очередь задач сжатия истории, обрабатываемая через Message Batches API."""
+
+    def __init__(
+        self, get_client: Callable[[], anthropic.AsyncAnthropic], db: Database,
+    ) -> None:
+        # Клиент берём при каждом обращении: AgentCore пересоздаёт его при refresh токена
+        self._get_client = get_client
+        self._db = db
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Запустить фоновый цикл отправки/сбора batch."""
+        if self._task and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._loop())
+        logger.info("Фоновое сжатие истории через Batches API запущено")
+
+    async def aclose(self) -> None:
+        """Остановить фоновый цикл (задачи в очереди остаются в БД)."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def enqueue(self, project_id: str, history_text: str, messages_end_id: int) -> None:
+        """Поставить сжатие истории проекта в очередь.
+
+        messages_end_id — id последнего сжимаемого сообщения (см. save_summary).
+        Если задача проекта ещё не отправлена — обновляем её на свежую;
+        если уже отправлена — ждём её результата и новую не создаём.
+        """
+        cursor = await self._db.execute(
+            "UPDATE summary_jobs SET history_text = ?, messages_end_id = ? "
+            "WHERE project_id = ? AND status = 'queued'",
+            (history_text, messages_end_id, project_id),
+        )
+        if cursor.rowcount == 0:
+            await self._db.execute(
+                "INSERT INTO summary_jobs (project_id, history_text, messages_end_id) "
+                "SELECT ?, ?, ? WHERE NOT EXISTS "
+                "(SELECT 1 FROM summary_jobs WHERE project_id = ? AND status = 'submitted')",
+                (project_id, history_text, messages_end_id, project_id),
+            )
+        await self._db.commit()
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            try:
+                await self._collect_finished()
+                await self._submit_queued()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Не валим цикл: задачи остаются в БД до следующей попытки
+                logger.exception("Ошибка фонового сжатия истории")
+
+    async def _submit_queued(self) -> None:
+        """Отправить все задачи из очереди одним batch."""
+        rows = await self._db.fetchall(
+            "SELECT id, history_text FROM summary_jobs WHERE status = 'queued'",
+        )
+        if not rows:
+            return
+
+        batch = await self._get_client().messages.batches.create(requests=[
+            {
+                "custom_id": f"{_CUSTOM_ID_PREFIX}{r['id']}",
+                "params": summary_request_params(r["history_text"]),
+            }
+            for r in rows
+        ])
+        await self._db.executemany(
+            "UPDATE summary_jobs SET status = 'submitted', batch_id = ? WHERE id = ?",
+            [(batch.id, r["id"]) for r in rows],
+        )
+        await self._db.commit()
+        logger.info("Сжатие истории: отправлен batch %s (%d задач)", batch.id, len(rows))
+
+    async def _collect_finished(self) -> None:
+        """Забрать резюме из завершённых batch и удалить их задачи."""
+        rows = await self._db.fetchall(
+            "SELECT id, project_id, batch_id, messages_end_id FROM summary_jobs "
+            "WHERE status = 'submitted'",
+        )
+        # batch_id → {custom_id: (project_id, messages_end_id)}
+        jobs_by_batch: dict[str, dict[str, tuple[str, int]]] = {}
+        for r in rows:
+            jobs_by_batch.setdefault(r["batch_id"], {})[
+                f"{_CUSTOM_ID_PREFIX}{r['id']}"
+            ] = (r["project_id"], r["messages_end_id"])
+
+        client = self._get_client()
+        for batch_id, jobs in jobs_by_batch.items():
+            batch = await client.messages.batches.retrieve(batch_id)
+            if batch.processing_status != "ended":
+                continue
+
+            async for item in await client.messages.batches.results(batch_id):
+                job = jobs.get(item.custom_id)
+                if job is None:
+                    continue
+                project_id, messages_end_id = job
+                if item.result.type != "succeeded":
+                    # Задача пропадёт; следующий ход снова поставит сжатие в очередь
+                    logger.warning(
+                        "Сжатие истории '%s' в batch %s: %s",
+                        project_id, batch_id, item.result.type,
+                    )
+                    continue
+                summary = item.result.message.content[0].text.strip()
+                await save_summary(self._db, project_id, summary, messages_end_id)
+
+            await self._db.execute("DELETE FROM summary_jobs WHERE batch_id = ?", (batch_id,))
+            await self._db.commit()
+            logger.info("Сжатие истории: batch %s обработан (%d задач)", batch_id, len(jobs))
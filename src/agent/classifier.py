@@ -7,28 +7,38 @@ from __future__ import annotations
 
 import json
 import logging
-from dataclasses import dataclass
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from functools import lru_cache
 from typing import Any
 
 import anthropic
+import orjson
 
-from src.mcp.types import MCP_TYPE_META, TOOL_PREFIX_MAP, McpServerType
+from src.mcp.types import MCP_TYPE_META, TOOL_PREFIX_MAP, McpServerType, McpTypeMeta
 
 logger = logging.getLogger(__name__)
 
 CLASSIFIER_MODEL = "claude-haiku-4-5"
 
+# category → (тип, meta): вместо перебора MCP_TYPE_META на каждую категорию
+_CATEGORY_TO_META: dict[str, tuple[McpServerType, McpTypeMeta]] = {}
+for _stype, _meta in MCP_TYPE_META.items():
+    _CATEGORY_TO_META.setdefault(_meta.category, (_stype, _meta))
 
-def _build_classification_prompt(available_categories: list[str]) -> str:
-    """Собрать промпт классификатора из доступных категорий."""
+
+@lru_cache(maxsize=32)
+def _build_classification_prompt(available_categories: tuple[str, ...]) -> str:
+    """Собрать промпт классификатора из доступных категорий.
+
+    Мемоизирован: набор категорий проекта меняется редко, а одинаковый
+    промпт байт-в-байт нужен и для prompt caching.
+    """
     category_lines = []
     for cat in available_categories:
-        # Ищем meta по category name
-        meta = None
-        for stype, m in MCP_TYPE_META.items():
-            if m.category == cat:
-                meta = m
-                break
+        entry = _CATEGORY_TO_META.get(cat)
+        meta = entry[1] if entry else None
         if meta:
             category_lines.append(f"- {cat}: {meta.capability_description}")
         else:
@@ -45,11 +55,16 @@ def _build_classification_prompt(available_categories: list[str]) -> str:
         "- needs_tools: нужны ли внешние инструменты для ответа\n"
         "- categories: какие категории нужны (пустой список если needs_tools=false)\n"
         "- is_simple: можно ли ответить коротко без глубокого анализа "
-        "(приветствие, благодарность, ок, простой вопрос)"
+        "(приветствие, благодарность, ок, простой вопрос)\n\n"
+        "Если запрос — приветствие, благодарность или подтверждение (\"ок\", \"понял\") "
+        "и для ответа не нужны ни инструменты, ни история диалога, добавь поле "
+        '"answer" с коротким дружелюбным ответом на языке пользователя:\n'
+        '{"needs_tools": false, "categories": [], "is_simple": true, "answer": "..."}'
     )
 
 
-def _build_tool_prefixes(categories: list[str]) -> list[str]:
+@lru_cache(maxsize=128)
+def _build_tool_prefixes(categories: tuple[str, ...]) -> tuple[str, ...]:
     """Преобразовать категории в префиксы для фильтрации инструментов.
 
     Собирает все tool_prefixes (read + write) из MCP_TYPE_META
@@ -57,13 +72,14 @@ def _build_tool_prefixes(categories: list[str]) -> list[str]:
     """
     prefixes: list[str] = []
     for cat in categories:
-        for stype, meta in MCP_TYPE_META.items():
-            if meta.category == cat:
-                ns_prefix = TOOL_PREFIX_MAP.get(stype, "")
-                for p in meta.all_prefixes:
-                    prefixes.append(ns_prefix + p if ns_prefix else p)
-                break
-    return prefixes
+        entry = _CATEGORY_TO_META.get(cat)
+        if not entry:
+            continue
+        stype, meta = entry
+        ns_prefix = TOOL_PREFIX_MAP.get(stype, "")
+        for p in meta.all_prefixes:
+            prefixes.append(ns_prefix + p if ns_prefix else p)
+    return tuple(prefixes)
 
 
 @dataclass
@@ -71,11 +87,91 @@ class RequestClassification:
     needs_tools: bool
     categories: list[str]
     is_simple: bool
+    # Готовый ответ на small talk — тогда второй вызов модели не нужен
+    answer: str = ""
+    tokens_input: int = 0
+    tokens_output: int = 0
 
     @property
-    def tool_prefixes(self) -> list[str]:
+    def tool_prefixes(self) -> tuple[str, ...]:
         """Преобразовать категории в префиксы для фильтрации инструментов."""
-        return _build_tool_prefixes(self.categories)
+        return _build_tool_prefixes(tuple(self.categories))
+
+
+# Очевидный small talk целиком: приветствие, благодарность, подтверждение.
+# Только полное совпадение — короткие follow-up вроде "а за вчера?" зависят
+# от истории и могут требовать инструментов, их решает Haiku.
+_SMALL_TALK_RE = re.compile(
+    r"(привет\w*|здравствуй\w*|добр\w+ (утро|день|вечер)|доброе|hi|hello|hey"
+    r"|спасибо|спс|благодарю|thanks|thank you|thx"
+    r"|ок|окей|ok|okay|понял\w*|ясно|хорошо|отлично|супер|класс|круто"
+    r"|пока|до свидания|bye)"
+    r"[\s!.,)(]*",
+    re.IGNORECASE,
+)
+# Сообщение без букв и цифр (эмодзи, "!!!", "+") — тоже small talk
+_NO_WORDS_RE = re.compile(r"[\W_]+")
+_QUICK_MAX_LEN = 30
+
+
+def quick_classify(user_message: str) -> RequestClassification | None:
+    """Локальная классификация очевидных случаев без вызова Haiku.
+
+    Возвращает простой запрос без инструментов для приветствий,
+    благодарностей, подтверждений и сообщений из одних эмодзи;
+    None — если нужен полноценный классификатор.
+    """
+    msg = user_message.strip()
+    if not msg or len(msg) > _QUICK_MAX_LEN:
+        return None
+    if _SMALL_TALK_RE.fullmatch(msg) or _NO_WORDS_RE.fullmatch(msg):
+        return RequestClassification(needs_tools=False, categories=[], is_simple=True)
+    return None
+
+
+# Поиск первого JSON-объекта в тексте: raw_decode разбирает ровно один
+# объект от заданной позиции и не захватывает следующие {...}
+_JSON_DECODER = json.JSONDecoder()
+
+
+def _first_json_object(text: str) -> dict[str, Any] | None:
+    """Первый JSON-объект в тексте (если модель добавила текст вокруг JSON)."""
+    start = text.find("{")
+    while start != -1:
+        try:
+            data, _ = _JSON_DECODER.raw_decode(text, start)
+        except json.JSONDecodeError:
+            data = None
+        if isinstance(data, dict):
+            return data
+        start = text.find("{", start + 1)
+    return None
+
+
+def _parse_json_answer(text: str) -> dict[str, Any]:
+    """Разобрать JSON-ответ классификатора, терпимо к markdown-ограждению.
+
+    Неразобранный ответ означает fallback на ВСЕ инструменты для основной
+    модели — это на порядки дороже самого классификатора, поэтому
+    пробуем снять ```json и вырезать {...} перед тем как сдаться.
+    """
+    text = text.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    try:
+        data = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        data = _first_json_object(text)
+        if data is None:
+            raise
+    if not isinstance(data, dict):
+        raise TypeError(f"Ожидался JSON-объект, получено: {type(data).__name__}")
+    return data
+
+
+# LRU-кеш классификаций: (нормализованный запрос, категории) → результат.
+# Повторяющиеся короткие сообщения ("ок", "спасибо") не ходят в Haiku повторно.
+# Доступ только из event loop без await между чтением и записью — lock не нужен.
+_CLASSIFY_CACHE_SIZE = 4096
+_classify_cache: OrderedDict[tuple[str, tuple[str, ...]], RequestClassification] = OrderedDict()
 
 
 async def classify_request(
@@ -86,30 +182,52 @@ async def classify_request(
     """Классифицировать запрос пользователя через Haiku.
 
     Стоимость: ~200 input + ~50 output токенов = ~$0.0003
+    (повторный запрос с теми же категориями — из LRU-кеша, бесплатно).
+    На small talk классификатор сразу возвращает answer — отдельный
+    вызов для простого ответа не нужен.
     """
-    prompt = _build_classification_prompt(available_categories)
+    cache_key = (user_message.strip().lower(), tuple(sorted(available_categories)))
+    cached = _classify_cache.get(cache_key)
+    if cached is not None:
+        _classify_cache.move_to_end(cache_key)
+        return cached
+
+    prompt = _build_classification_prompt(tuple(available_categories))
 
     try:
         response = await client.messages.create(
             model=CLASSIFIER_MODEL,
-            max_tokens=100,
-            system=prompt,
+            max_tokens=300,  # JSON + короткий answer
+            # Промпт мемоизирован → префикс байт-в-байт одинаковый между вызовами.
+            # Кеш срабатывает, только если промпт длиннее минимального
+            # кешируемого размера модели; иначе cache_control просто игнорируется.
+            system=[{
+                "type": "text",
+                "text": prompt,
+                "cache_control": {"type": "ephemeral"},
+            }],
             messages=[{
                 "role": "user",
                 "content": f"Доступные категории: {', '.join(available_categories)}\n\nЗапрос: {user_message}",
             }],
         )
 
-        text = response.content[0].text.strip()
-        data = json.loads(text)
+        text = next(
+            (b.text for b in response.content if getattr(b, "type", None) == "text"), "",
+        )
+        data = _parse_json_answer(text)
 
         # Фильтруем категории — оставляем только реально доступные
         categories = [c for c in data.get("categories", []) if c in available_categories]
 
-        return RequestClassification(
+        answer = data.get("answer")
+        result = RequestClassification(
             needs_tools=data.get("needs_tools", True),
             categories=categories,
             is_simple=data.get("is_simple", False),
+            answer=answer.strip() if isinstance(answer, str) else "",
+            tokens_input=response.usage.input_tokens,
+            tokens_output=response.usage.output_tokens,
         )
     except Exception:
         logger.debug("Классификатор не смог разобрать ответ, используем все инструменты")
@@ -118,3 +236,11 @@ async def classify_request(
             categories=available_categories,
             is_simple=False,
         )
+
+    # Fallback не кешируем — при следующем запросе классификатор попробует снова.
+    # Готовый answer и usage в кеш не кладём: повтор пойдёт через обычный
+    # простой ответ с историей, а не одной и той же фразой.
+    _classify_cache[cache_key] = replace(result, answer="", tokens_input=0, tokens_output=0)
+    if len(_classify_cache) > _CLASSIFY_CACHE_SIZE:
+        _classify_cache.popitem(last=False)
+    return result
@@ -0,0 +1,72 @@
+"""Дословное сжатие результатов инструментов (без пересказа).
+
+Удаляет малоинформативные строки — HTML-мусор, base64, повторы, а для
+писем (email=True) ещё подписи и цитаты предыдущих писем — но оставшийся
+текст не переписывает: ID, адреса и ссылки доходят до модели без искажений.
+Правила для писем к другим инструментам не применяются: в Slack, Jira,
+Confluence строки с ">" и "--" — это данные, а не цитаты и подписи.
+"""
+
+from __future__ import annotations
+
+import re
+
+# Минимальная длина непрерывного base64, которую считаем вложением/картинкой
+_BASE64_MIN_LEN = 200
+
+_HTML_NOISE_RE = re.compile(
+    r"<(style|script)\b[^>]*>.*?</\1\s*>|<!--.*?-->", re.IGNORECASE | re.DOTALL,
+)
+_BASE64_RE = re.compile(rf"[A-Za-z0-9+/]{{{_BASE64_MIN_LEN},}}={{0,2}}")
+# Подпись: разделитель RFC 3676 (ровно "-- ") и до _SIGNATURE_MAX_LINES строк
+# до пустой строки (ограничение — чтобы не съесть следующее письмо)
+_SIGNATURE_MAX_LINES = 6
+_SIGNATURE_RE = re.compile(rf"^-- \n(?:.+\n?){{0,{_SIGNATURE_MAX_LINES}}}", re.MULTILINE)
+# Цитата ответа: "On ... wrote:" / "... пишет:" и хотя бы одна строка с ">"
+_QUOTE_HEADER_RE = re.compile(
+    r"^(?:On .{1,200} wrote:|.{1,200} пишет:)[ \t]*\n(?:>.*\n?)+", re.MULTILINE,
+)
+_QUOTED_LINES_RE = re.compile(r"^>.*\n?", re.MULTILINE)
+_TRAILING_SPACES_RE = re.compile(r"[ \t]+$", re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def _elide_base64(match: re.Match[str]) -> str:
+    return f"<elided {len(match.group())} bytes>"
+
+
+def _collapse_repeats(text: str) -> str:
+    """Схлопнуть подряд идущие одинаковые непустые строки (повторы стектрейсов)."""
+    lines = text.split("\n")
+    result: list[str] = []
+    repeats = 0
+    for line in lines:
+        if result and line and line == result[-1]:
+            repeats += 1
+            continue
+        if repeats:
+            result[-1] += f"  [×{repeats + 1}]"
+            repeats = 0
+        result.append(line)
+    if repeats:
+        result[-1] += f"  [×{repeats + 1}]"
+    return "\n".join(result)
+
+
+def compact_tool_result(text: str, *, email: bool = False) -> str:
+    """Удалить малоинформативные строки из результата инструмента.
+
+    email=True — результат почтового инструмента: дополнительно удаляются
+    цитаты предыдущих писем и подписи.
+    """
+    if not text:
+        return text
+    text = _HTML_NOISE_RE.sub("", text)
+    text = _BASE64_RE.sub(_elide_base64, text)
+    if email:
+        text = _QUOTE_HEADER_RE.sub("", text)
+        text = _QUOTED_LINES_RE.sub("", text)
+        text = _SIGNATURE_RE.sub("", text)
+    text = _TRAILING_SPACES_RE.sub("", text)
+    text = _collapse_repeats(text)
+    return _BLANK_LINES_RE.sub("\n\n", text).strip()
@@ -2,63 +2,217 @@
 
 from __future__ import annotations
 
-import json
+import logging
+import re
+import sys
 from typing import Any
 
-from src.db.models import Conversation
-from src.utils.tokens import estimate_tokens
+from src.utils.tokens import estimate_tokens_from_chars
 
+logger = logging.getLogger(__name__)
 
-def build_messages_from_history(history: list[Conversation]) -> list[dict[str, Any]]:
-    """Собрать список messages для Anthropic API из истории БД."""
-    messages: list[dict[str, Any]] = []
-    for msg in history:
-        try:
-            content = json.loads(msg.content)
-        except (json.JSONDecodeError, TypeError):
-            content = msg.content
+# До какой доли лимита обрезать историю при превышении (гистерезис для кеша)
+TRIM_TARGET_RATIO = 0.6
+# Веса ходов при обрезке: результаты инструментов, поправки пользователя,
+# свежие ходы (последние TRIM_RECENT_TURNS) — остальные имеют вес 1
+TRIM_WEIGHT_TOOL_RESULT = 3
+TRIM_WEIGHT_CORRECTION = 2
+TRIM_WEIGHT_RECENT = 2
+TRIM_RECENT_TURNS = 5
+# Начало сообщения-резюме (см. summarizer.maybe_summarize): такой ход
+# в начале истории закреплён — это стабильный префикс для prompt cache
+SUMMARY_PREFIX = "[Краткое резюме предыдущего разговора]"
+_CORRECTION_RE = re.compile(
+    r"\b(?:нет|неправильно|неверно|не то|ошиб\w*|fix|wrong)\b", re.IGNORECASE,
+)
 
-        messages.append({"role": msg.role, "content": content})
+# SQLite отдаёт новый str на каждую строку — роли интернируем, чтобы
+# длинная история не держала сотни копий "user"/"assistant"
+_ROLES = {r: sys.intern(r) for r in ("user", "assistant", "system")}
 
-    return messages
 
+def build_messages_from_history(history: list[tuple[str, str]]) -> list[dict[str, Any]]:
+    """Собрать список messages для Anthropic API из истории БД.
 
-def trim_messages(messages: list[dict[str, Any]], max_tokens: int = 4_000) -> list[dict[str, Any]]:
+    history — пары (role, content) из get_conversation_turns.
+    Текст хранится в БД как есть (без JSON-кодирования), поэтому
+    content передаётся без разбора.
+    """
+    return [
+        {"role": _ROLES.get(role, role), "content": content}
+        for role, content in history
+    ]
+
+
+def add_cache_breakpoints(
+    messages: list[dict[str, Any]],
+    count: int,
+    cache_control: dict[str, Any],
+) -> list[dict[str, Any]]:
+    """Поставить cache_control на последние `count` user-сообщений.
+
+    Последнее сообщение — граница кеша, которую прочитает следующий вызов;
+    предыдущее user-сообщение — граница, записанная прошлым вызовом.
+    Так каждый ход читает из кеша всю уже отправленную историю.
+
+    Исходный список и сообщения не мутируются (messages уходят в snapshot
+    для approval): помеченные сообщения копируются, строковый content
+    переводится в форму блоков.
+    """
+    if count <= 0 or not messages:
+        return messages
+
+    result = list(messages)
+    marked = 0
+    for i in range(len(result) - 1, -1, -1):
+        if marked >= count:
+            break
+        msg = result[i]
+        if msg.get("role") != "user":
+            continue
+        content = msg.get("content")
+        if isinstance(content, str):
+            if not content:
+                continue
+            blocks = [{"type": "text", "text": content, "cache_control": cache_control}]
+        elif isinstance(content, list) and content and isinstance(content[-1], dict):
+            blocks = [*content[:-1], {**content[-1], "cache_control": cache_control}]
+        else:
+            continue
+        result[i] = {**msg, "content": blocks}
+        marked += 1
+    return result
+
+
+def trim_messages(
+    messages: list[dict[str, Any]],
+    max_tokens: int = 4_000,
+    target_ratio: float = TRIM_TARGET_RATIO,
+) -> list[dict[str, Any]]:
     """Обрезать историю сообщений, чтобы уложиться в лимит токенов.
 
-    Стратегия: сохраняем системный промпт + последние N сообщений.
-    Удаляем самые старые сообщения первыми.
+    Стратегия: история делится на ходы (user-сообщение + ответы и
+    tool_result к нему), последний ход и резюме в начале истории
+    сохраняются всегда — префикс с резюме остаётся в кеше. Остальные
+    ходы отбираются жадным рюкзаком по весу на токен (_turn_weight):
+    результаты инструментов, поправки пользователя и свежие ходы
+    ценнее. Ходы удаляются целиком — пары tool_use/tool_result и
+    чередование ролей не разрываются.
+
+    Пока история в пределах max_tokens — список не меняется (префикс
+    в prompt cache стабилен); тот же объект возвращается и когда удалить
+    нечего — закреплённые ходы сами больше лимита. При превышении режем с запасом, до
+    max_tokens * target_ratio: иначе каждая следующая итерация tool loop
+    снова срезала бы по сообщению и каждый вызов промахивался мимо кеша.
     """
     if not messages:
         return messages
 
-    total = _estimate_messages_tokens(messages)
+    # Считаем токены каждого сообщения один раз
+    counts = [_estimate_message_tokens(m) for m in messages]
+    total = sum(counts)
     if total <= max_tokens:
         return messages
 
-    # Убираем старые сообщения, начиная с начала (сохраняя последние)
-    trimmed = list(messages)
-    while len(trimmed) > 2 and _estimate_messages_tokens(trimmed) > max_tokens:
-        trimmed.pop(0)
+    turns = _split_turns(messages)
+    turn_tokens = [sum(counts[i] for i in turn) for turn in turns]
+
+    # Закреплены последний ход (новый запрос пользователя) и резюме в начале
+    # истории; при равной ценности на токен предпочитаем более свежие ходы
+    pinned = {len(turns) - 1}
+    first = messages[0].get("content")
+    if isinstance(first, str) and first.startswith(SUMMARY_PREFIX):
+        pinned.add(0)
+    budget = int(max_tokens * target_ratio) - sum(turn_tokens[t] for t in pinned)
+    candidates = sorted(
+        (t for t in range(len(turns)) if t not in pinned),
+        key=lambda t: (
+            _turn_weight(messages, turns[t], len(turns) - 1 - t) / turn_tokens[t], t,
+        ),
+        reverse=True,
+    )
+    kept = set(pinned)
+    for t in candidates:
+        if turn_tokens[t] <= budget:
+            kept.add(t)
+            budget -= turn_tokens[t]
+
+    if len(kept) == len(turns):
+        # Не влезает один закреплённый ход — резать нечего, префикс не меняется
+        return messages
 
+    trimmed = [messages[i] for t in sorted(kept) for i in turns[t]]
+    logger.warning(
+        "История обрезана: удалено %d из %d сообщений (~%d tokens осталось) — "
+        "префикс изменился, prompt cache промахнётся",
+        len(messages) - len(trimmed), len(messages),
+        sum(turn_tokens[t] for t in kept),
+    )
     return trimmed
 
 
-def _estimate_messages_tokens(messages: list[dict[str, Any]]) -> int:
+def _is_tool_result(msg: dict[str, Any]) -> bool:
+    content = msg.get("content")
+    return (
+        isinstance(content, list)
+        and any(isinstance(b, dict) and b.get("type") == "tool_result" for b in content)
+    )
+
+
+def _split_turns(messages: list[dict[str, Any]]) -> list[list[int]]:
+    """Разбить историю на ходы — списки индексов сообщений.
+
+    Ход начинается с user-сообщения, которое не является tool_result;
+    ответы ассистента и tool_result к его tool_use входят в тот же ход.
+    """
+    turns: list[list[int]] = []
+    for i, msg in enumerate(messages):
+        if not turns or (msg["role"] == "user" and not _is_tool_result(msg)):
+            turns.append([i])
+        else:
+            turns[-1].append(i)
+    return turns
+
+
+def _turn_weight(messages: list[dict[str, Any]], turn: list[int], age: int) -> int:
+    """Ценность хода для trim_messages (age — сколько ходов после него)."""
+    weight = TRIM_WEIGHT_RECENT if age < TRIM_RECENT_TURNS else 1
+    for i in turn:
+        msg = messages[i]
+        if _is_tool_result(msg):
+            weight = max(weight, TRIM_WEIGHT_TOOL_RESULT)
+        elif (
+            msg["role"] == "user"
+            and isinstance(msg["content"], str)
+            and _CORRECTION_RE.search(msg["content"])
+        ):
+            weight = max(weight, TRIM_WEIGHT_CORRECTION)
+    return weight
+
+
+def estimate_messages_tokens(messages: list[dict[str, Any]]) -> int:
     """Оценить количество токенов в списке сообщений."""
-    total = 0
-    for msg in messages:
-        content = msg.get("content", "")
-        if isinstance(content, str):
-            total += estimate_tokens(content)
-        elif isinstance(content, list):
-            for block in content:
-                if isinstance(block, dict):
-                    if "text" in block:
-                        total += estimate_tokens(block["text"])
-                    elif "content" in block:
-                        total += estimate_tokens(str(block["content"]))
-                else:
-                    total += estimate_tokens(str(block))
-        total += 10  # overhead per message
-    return total
+    return sum(_estimate_message_tokens(m) for m in messages)
+
+
+def _estimate_message_tokens(msg: dict[str, Any]) -> int:
+    """Оценить количество токенов в одном сообщении.
+
+    Оценка линейна по длине, поэтому суммируем длины блоков
+    и вызываем оценщик один раз на сообщение.
+    """
+    chars = 0
+    content = msg.get("content", "")
+    if isinstance(content, str):
+        chars = len(content)
+    elif isinstance(content, list):
+        for block in content:
+            if isinstance(block, dict):
+                if "text" in block:
+                    chars += len(block["text"])
+                elif "content" in block:
+                    inner = block["content"]
+                    chars += len(inner if isinstance(inner, str) else str(inner))
+            else:
+                chars += len(str(block))
+    return estimate_tokens_from_chars(chars) + 10  # overhead per message
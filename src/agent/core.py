@@ -1,7 +1,7 @@
 """Ядро агента: цикл tool_use с Claude API.
 
 Оптимизации:
-- Prompt caching: system prompt + tools кешируются (экономия ~60-70%)
+- Prompt caching: system prompt + tools + история кешируются (экономия ~60-70%)
 - Haiku-классификатор: определяет нужны ли tools и какие (~$0.0003/запрос)
 - History summarization: сжимает старую историю через Haiku
 """
@@ -9,35 +9,59 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import logging
+import random
 import time
+from collections.abc import Awaitable, Callable
 from dataclasses import dataclass, field
+from datetime import UTC, datetime
 from typing import Any
 
 import anthropic
 
 from src.agent.auth import OAuthRefreshError, OAuthRefresher
-from src.agent.classifier import RequestClassification, classify_request
-from src.agent.context import build_messages_from_history, trim_messages
-from src.agent.prompts import build_system_prompt
+from src.agent.batch_summarizer import BatchSummarizer
+from src.agent.classifier import (
+    CLASSIFIER_MODEL,
+    RequestClassification,
+    classify_request,
+    quick_classify,
+)
+from src.agent.compactor import compact_tool_result
+from src.agent.context import (
+    add_cache_breakpoints,
+    build_messages_from_history,
+    estimate_messages_tokens,
+    trim_messages,
+)
+from src.agent.local_classifier import local_classify
+from src.agent.prompts import build_system_prompt, build_time_context
 from src.agent.summarizer import maybe_summarize
 from src.agent.tools import mcp_tools_to_anthropic
 from src.db.database import Database
 from src.db.queries import (
-    get_conversation_history,
+    expire_approval_contexts,
+    get_conversation_turns,
     log_tool_call,
+    log_tool_calls,
     save_message,
+    save_messages_batch,
+    tool_call_row,
     track_cost,
 )
 from src.mcp.manager import MCPManager
-from src.mcp.types import MCP_TYPE_META
-from src.settings import Settings
+from src.mcp.types import MCP_TYPE_META, READ_TOOL_PREFIXES, McpServerType
+from src.settings import ProjectConfig, Settings
+from src.utils.tokens import estimate_tokens
 
 logger = logging.getLogger(__name__)
 
 MAX_TOOL_ITERATIONS = 15
 MAX_TOKENS_BUDGET = 50_000  # Лимит по токенам на один запрос пользователя
+# Контекстное окно модели и доля от него, после которой tool loop
+# останавливается, не отправляя заведомо слишком большой запрос
+CONTEXT_WINDOW_TOKENS = 200_000
+CONTEXT_BUDGET_RATIO = 0.9
 
 # Per-tool лимиты обрезки результатов (символов).
 # Gmail/Calendar возвращают структурированные данные — нужен больший лимит,
@@ -48,10 +72,44 @@ TOOL_RESULT_LIMITS: dict[str, int] = {
     "list-events": 6000,
     "search-events": 6000,
 }
-DEFAULT_TOOL_RESULT_LIMIT = 2000
-
-
-@dataclass
+# Дефолтный лимит — global.tool_result_max_chars.
+# От MCP читаем не больше лимита × фактор: остальное всё равно будет обрезано
+TOOL_RESULT_READ_FACTOR = 4
+# Инструменты Gmail (без namespace prefix): только к их результатам
+# применяются правила сжатия писем — цитаты и подписи
+EMAIL_TOOL_PREFIXES = tuple(MCP_TYPE_META[McpServerType.gmail].all_prefixes)
+
+# Таймаут Anthropic API: connect короткий, чтобы сетевые проблемы
+# не съедали весь 60-секундный бюджет запроса
+API_TIMEOUT = anthropic.Timeout(60.0, connect=5.0)
+
+# Повторы при 429/529: экспоненциальный backoff с jitter (секунды)
+RETRY_BASE_WAIT = 5.0
+RETRY_MAX_WAIT = 120.0
+RETRY_JITTER = 1.0
+# Лимиты Anthropic: заголовки anthropic-ratelimit-<kind>-remaining / -reset (RFC 3339)
+RATELIMIT_KINDS = ("requests", "tokens", "input-tokens", "output-tokens")
+
+# Snapshot разговора у неподтверждённого approval хранится не дольше часа;
+# очистка — при старте и затем раз в APPROVAL_CLEANUP_INTERVAL (секунды)
+APPROVAL_CONTEXT_TTL = 3600
+APPROVAL_CLEANUP_INTERVAL = 3600.0
+
+# Anthropic API допускает не более 4 cache_control breakpoints на запрос
+MAX_CACHE_BREAKPOINTS = 4
+
+# Callback стриминга: получает весь накопленный текст текущего ответа Claude
+TextCallback = Callable[[str], Awaitable[None]]
+# Не чаще раза в столько секунд дёргаем callback (Telegram ограничивает edit)
+STREAM_UPDATE_INTERVAL = 1.0
+
+# Длительность TTL prompt cache в секундах (для keep-warm)
+CACHE_TTL_SECONDS: dict[str, int] = {"5m": 300, "1h": 3600}
+# Heartbeat отправляется до истечения TTL с запасом
+KEEPALIVE_TTL_FRACTION = 0.9
+
+
+@dataclass(slots=True)
 class AgentResponse:
     """Результат работы агента."""
     text: str
@@ -60,10 +118,10 @@ class AgentResponse:
     tokens_output: int = 0
     model: str = ""
     pending_approval: PendingApproval | None = None
-    cache_stats: str = ""  # "read:X write:Y" для диагностики
+    cache_stats: str = ""  # "read:X write:Y (1h:A 5m:B)" для диагностики
 
 
-@dataclass
+@dataclass(slots=True)
 class PendingApproval:
     """Инструмент, ожидающий подтверждения пользователя."""
     tool_name: str
@@ -72,6 +130,40 @@ class PendingApproval:
     messages_snapshot: list[dict[str, Any]] = field(default_factory=list)
 
 
+@dataclass(slots=True)
+class TokenBudget:
+    """Бюджет токенов на один запрос пользователя (tool loop).
+
+    Учитываются некешированный input и output — то, что оплачивается
+    по полной цене; чтение из prompt cache в бюджет не входит.
+    """
+    limit: int
+    spent_input: int = 0
+    spent_output: int = 0
+
+    @property
+    def spent(self) -> int:
+        return self.spent_input + self.spent_output
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.limit - self.spent)
+
+    def consume(self, usage: Any) -> None:
+        self.spent_input += usage.input_tokens
+        self.spent_output += usage.output_tokens
+
+    def fits(self, projected: int) -> bool:
+        """Уложится ли следующий вызов с прогнозом projected токенов."""
+        return projected <= self.remaining
+
+    def breakdown(self) -> str:
+        return (
+            f"in:{self.spent_input} out:{self.spent_output} "
+            f"осталось:{self.remaining}/{self.limit}"
+        )
+
+
 class AgentCore:
     """Основной цикл агента с оптимизациями токенов."""
 
@@ -79,69 +171,176 @@ class AgentCore:
         self.settings = settings
         self.db = db
         self.mcp = mcp_manager
-        self.client = self._create_client(settings)
+        # Один пул соединений на весь процесс: классификатор, summarizer и
+        # основной цикл ходят через self.client, а при пересоздании клиента
+        # после OAuth refresh старые сокеты не утекают — пул тот же
+        self._http_client = anthropic.DefaultAsyncHttpxClient()
+        self.client = self._create_client(settings, self._http_client)
+        # Токен, с которым создан self.client (для пересоздания после refresh)
+        self._client_token = settings.anthropic_auth_token
         self._refresher: OAuthRefresher | None = (
             OAuthRefresher(settings)
             if settings.global_config.auth_method == "oauth"
             else None
         )
+        self._batch_summarizer: BatchSummarizer | None = (
+            BatchSummarizer(lambda: self.client, db)
+            if settings.global_config.batch_summarization
+            else None
+        )
+        # Кеши производных от конфига проекта и реестра MCP данных.
+        # Значение — (ключ версии, данные); ключ см. _project_version.
+        self._categories_cache: dict[str, tuple[tuple, list[str]]] = {}
+        self._connected_cache: dict[str, tuple[tuple, list[str]]] = {}
+        self._tools_cache: dict[
+            tuple[str, tuple[str, ...] | None], tuple[tuple, list[dict[str, Any]], int]
+        ] = {}
+        # id(tools) → (tools, оценка токенов); tools храним, чтобы id не переиспользовался
+        self._tools_tokens: dict[int, tuple[list[dict[str, Any]], int]] = {}
+        # Keep-warm prompt cache: project_id → task / последний префикс / активность
+        self._heartbeats: dict[str, asyncio.Task] = {}
+        self._warm_prefix: dict[str, tuple[str, str, list[dict[str, Any]]]] = {}
+        self._last_activity: dict[str, float] = {}
+        self._approval_cleanup: asyncio.Task | None = None
+        # Фоновые задачи (учёт расходов) — держим ссылки, чтобы их не собрал GC
+        self._bg_tasks: set[asyncio.Task] = set()
 
     @staticmethod
-    def _create_client(settings: Settings) -> anthropic.AsyncAnthropic:
+    def _create_client(
+        settings: Settings, http_client: anthropic.DefaultAsyncHttpxClient,
+    ) -> anthropic.AsyncAnthropic:
         """Создать Anthropic-клиент с учётом метода авторизации."""
         if settings.global_config.auth_method == "oauth" and settings.anthropic_auth_token:
             logger.info("Используем OAuth от подписки Claude")
             return anthropic.AsyncAnthropic(
                 auth_token=settings.anthropic_auth_token,
                 max_retries=2,
-                timeout=60.0,
+                timeout=API_TIMEOUT,
+                http_client=http_client,
                 default_headers={"anthropic-beta": "oauth-2025-04-20"},
             )
         logger.info("Используем API key")
         return anthropic.AsyncAnthropic(
             api_key=settings.anthropic_api_key,
             max_retries=2,
-            timeout=60.0,
+            timeout=API_TIMEOUT,
+            http_client=http_client,
         )
 
+    def start(self) -> None:
+        """Запустить фоновые задачи агента.
+
+        Refresh OAuth токена, batch-сжатие истории, очистка устаревших
+        snapshot в approval_requests.
+        """
+        if self._refresher:
+            self._refresher.start()
+        if self._batch_summarizer:
+            self._batch_summarizer.start()
+        if self._approval_cleanup is None or self._approval_cleanup.done():
+            self._approval_cleanup = asyncio.create_task(self._approval_cleanup_loop())
+
+    async def _approval_cleanup_loop(self) -> None:
+        """Периодически удалять snapshot у approval, по которым не нажали кнопку."""
+        while True:
+            try:
+                cleared = await expire_approval_contexts(self.db, APPROVAL_CONTEXT_TTL)
+                if cleared:
+                    logger.info("Удалены устаревшие snapshot approval: %d", cleared)
+            except Exception:
+                logger.exception("Ошибка очистки snapshot approval")
+            await asyncio.sleep(APPROVAL_CLEANUP_INTERVAL)
+
+    async def close(self) -> None:
+        """Освободить сетевые ресурсы агента (вызывается при shutdown)."""
+        for task in self._heartbeats.values():
+            task.cancel()
+        self._heartbeats.clear()
+        if self._approval_cleanup:
+            self._approval_cleanup.cancel()
+            self._approval_cleanup = None
+        # Дожидаемся фоновых записей в БД до её закрытия
+        if self._bg_tasks:
+            await asyncio.gather(*self._bg_tasks, return_exceptions=True)
+        if self._refresher:
+            await self._refresher.aclose()
+        if self._batch_summarizer:
+            await self._batch_summarizer.aclose()
+        await self._http_client.aclose()
+
     async def run(
         self,
         project_id: str,
         user_message: str,
         model: str | None = None,
+        on_text: TextCallback | None = None,
     ) -> AgentResponse:
-        """Выполнить один цикл агента для пользовательского запроса."""
+        """Выполнить один цикл агента для пользовательского запроса.
+
+        on_text — если передан, ответы Claude стримятся: callback получает
+        накопленный текст по мере генерации (для живого превью в Telegram).
+        """
         project = self.settings.projects.get(project_id)
         if not project:
             return AgentResponse(text=f"Проект '{project_id}' не найден.")
 
         model = model or self.settings.global_config.default_model
-        phase = project.phase
+
+        await self._ensure_fresh_client()
 
         # === Оптимизация 1: Haiku-классификатор ===
-        available_categories = self._get_available_categories(project_id)
-        classification = await classify_request(
-            self.client, user_message, available_categories,
-        )
-        logger.info(
-            "Классификация: tools=%s, categories=%s, simple=%s",
-            classification.needs_tools, classification.categories, classification.is_simple,
+        # Классификатор (Haiku) и чтение истории из БД независимы —
+        # запускаем параллельно, системный промпт собираем пока они в полёте
+        # Очевидные случаи классифицируем локально, без вызова Haiku:
+        # small talk и явные упоминания подключённых сервисов
+        quick = quick_classify(user_message)
+        cls_task = None
+        if quick is None:
+            available_categories = self._get_available_categories(project_id)
+            if self.settings.global_config.local_classifier:
+                quick = local_classify(user_message, available_categories)
+        if quick is None:
+            logger.info("routing.decision source=haiku")
+            cls_task = asyncio.create_task(
+                classify_request(self.client, user_message, available_categories),
+            )
+        history_task = asyncio.create_task(
+            get_conversation_turns(self.db, project_id, limit=20),
         )
+        try:
+            # 1. Системный промпт
+            system_prompt = self._get_system_prompt(project_id, project)
+
+            classification = quick or await cls_task
+            logger.info(
+                "Классификация: tools=%s, categories=%s, simple=%s",
+                classification.needs_tools, classification.categories, classification.is_simple,
+            )
+
+            # Классификатор уже ответил на small talk — второй вызов Haiku не нужен
+            if (classification.answer and classification.is_simple
+                    and not classification.needs_tools):
+                return await self._classifier_answer(project_id, user_message, classification)
+
+            # 2. История из БД
+            history = await history_task
+        finally:
+            for task in (cls_task, history_task):
+                if task is not None and not task.done():
+                    task.cancel()
 
         # Простой запрос без инструментов → отвечаем через Haiku
         if classification.is_simple and not classification.needs_tools:
-            return await self._simple_response(project_id, project, user_message, phase)
-
-        # 1. Системный промпт
-        connected = self._get_connected_services(project_id)
-        system_prompt = build_system_prompt(project_id, project, phase, connected)
+            return await self._simple_response(
+                project_id, user_message, system_prompt, history[-6:], on_text,
+            )
 
-        # 2. История из БД
-        history = await get_conversation_history(self.db, project_id, limit=20)
         messages = build_messages_from_history(history)
 
         # === Оптимизация 3: Summarization ===
-        messages = await maybe_summarize(self.client, self.db, project_id, messages)
+        messages = await maybe_summarize(
+            self.client, self.db, project_id, messages, self._batch_summarizer,
+        )
 
         # Добавляем новое сообщение
         messages.append({"role": "user", "content": user_message})
@@ -149,164 +348,183 @@ class AgentCore:
 
         # 3. Инструменты — фильтруем по классификации
         if classification.needs_tools:
-            project_tools = self.mcp.get_project_tools(project_id)
             # Дополнительная фильтрация по категориям от классификатора
-            if classification.categories:
-                prefixes = classification.tool_prefixes
-                project_tools = [
-                    t for t in project_tools
-                    if any(t["name"].startswith(p) for p in prefixes)
-                ] or project_tools  # fallback: все инструменты если фильтр пустой
-            anthropic_tools = mcp_tools_to_anthropic(project_tools)
+            prefixes = classification.tool_prefixes if classification.categories else None
+            anthropic_tools, total_tools = self._get_anthropic_tools(
+                project_id, project, prefixes,
+            )
             logger.info(
                 "Инструменты: %d из %d (префиксы: %s)",
-                len(anthropic_tools),
-                len(self.mcp.get_project_tools(project_id)),
-                classification.tool_prefixes if classification.categories else "все",
+                len(anthropic_tools), total_tools, prefixes or "все",
             )
         else:
             anthropic_tools = []
 
         approval_list = self.mcp.get_tools_requiring_approval(project_id)
 
+        if anthropic_tools:
+            self._keep_warm(project_id, model, system_prompt, anthropic_tools)
+
         # 4. Цикл tool_use
         total_input = 0
         total_output = 0
         total_cache_read = 0
         total_cache_write = 0
+        total_cache_write_1h = 0
+        total_cache_write_5m = 0
         tool_calls_count = 0
-
-        # Логируем размер запроса для диагностики
-        from src.utils.tokens import estimate_tokens
+        budget = TokenBudget(MAX_TOKENS_BUDGET)
+        # Текст последнего ответа с tool_use — частичный ответ при остановке
+        partial_text = ""
+        # Оценка сообщений, добавленных после прошлого вызова (вне кеша)
+        est_delta = 0
+
+        # Оценка размера запроса: system и tools постоянны (оценка tools
+        # мемоизирована), messages считаются один раз и дальше обновляются
+        # инкрементально — при добавлении сообщений и при обрезке
         est_sys = estimate_tokens(system_prompt)
-        est_msgs = sum(
-            estimate_tokens(str(m.get("content", ""))) + 10 for m in messages
-        )
-        est_tools = sum(
-            estimate_tokens(str(t)) for t in anthropic_tools
-        ) if anthropic_tools else 0
-        logger.info(
-            "Размер запроса: system~%d + msgs~%d + tools~%d = ~%d tokens",
-            est_sys, est_msgs, est_tools, est_sys + est_msgs + est_tools,
-        )
+        est_tools = self._estimate_tools_tokens(anthropic_tools)
+        est_msgs = estimate_messages_tokens(messages)
+        context_limit = int(CONTEXT_WINDOW_TOKENS * CONTEXT_BUDGET_RATIO)
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Размер запроса: system~%d + msgs~%d + tools~%d = ~%d tokens",
+                est_sys, est_msgs, est_tools, est_sys + est_msgs + est_tools,
+            )
 
         for iteration in range(MAX_TOOL_ITERATIONS):
-            logger.info("Итерация %d/%d, сообщений: %d, токены: %d",
+            logger.info("Итерация %d/%d, сообщений: %d, бюджет: %s",
                         iteration + 1, MAX_TOOL_ITERATIONS, len(messages),
-                        total_input + total_output)
-
-            # Проверка бюджета токенов
-            if total_input + total_output > MAX_TOKENS_BUDGET:
-                logger.warning("Бюджет токенов исчерпан (%d > %d)",
-                               total_input + total_output, MAX_TOKENS_BUDGET)
+                        budget.breakdown())
+
+            # Проверка бюджета до вызова: префикс прошлого вызова читается из
+            # кеша, по полной цене идут новые сообщения и ответ (до max_tokens)
+            projected_billed = est_delta + self.settings.global_config.max_tokens
+            if iteration and not budget.fits(projected_billed):
+                logger.warning("Бюджет токенов исчерпан (%s, прогноз вызова ~%d)",
+                               budget.breakdown(), projected_billed)
                 # Финальный вызов без tools — пусть Claude подведёт итог
                 response = await self._call_claude(
                     model=model, system=system_prompt,
-                    messages=messages, tools=None,
+                    messages=messages, tools=None, on_text=on_text,
                 )
                 total_input += response.usage.input_tokens
                 total_output += response.usage.output_tokens
                 text = self._extract_text(response) or "Бюджет токенов исчерпан. Вот что удалось выяснить."
                 break
 
+            # Прогноз размера следующего запроса: не отправляем то, что не влезет в контекст
+            projected = est_sys + est_tools + est_msgs
+            if projected > context_limit:
+                logger.warning(
+                    "Запрос не помещается в контекст (~%d > %d tokens), останавливаемся",
+                    projected, context_limit,
+                )
+                stop_note = "[Агент остановлен: достигнут лимит контекста]"
+                text = f"{partial_text}\n\n{stop_note}" if partial_text else stop_note
+                break
+
             response = await self._call_claude(
                 model=model,
                 system=system_prompt,
                 messages=messages,
                 tools=anthropic_tools if anthropic_tools else None,
+                on_text=on_text,
             )
 
             total_input += response.usage.input_tokens
             total_output += response.usage.output_tokens
-            if hasattr(response.usage, "cache_read_input_tokens"):
-                total_cache_read += response.usage.cache_read_input_tokens or 0
-            if hasattr(response.usage, "cache_creation_input_tokens"):
-                total_cache_write += response.usage.cache_creation_input_tokens or 0
+            budget.consume(response.usage)
+            total_cache_read += getattr(response.usage, "cache_read_input_tokens", 0) or 0
+            total_cache_write += getattr(response.usage, "cache_creation_input_tokens", 0) or 0
+            # Разбивка записи по TTL (есть в новых версиях API/SDK)
+            cache_creation = getattr(response.usage, "cache_creation", None)
+            if cache_creation is not None:
+                total_cache_write_1h += cache_creation.ephemeral_1h_input_tokens or 0
+                total_cache_write_5m += cache_creation.ephemeral_5m_input_tokens or 0
 
             if response.stop_reason == "end_turn":
                 text = self._extract_text(response)
                 break
 
             if response.stop_reason == "tool_use":
-                tool_blocks = [b for b in response.content if b.type == "tool_use"]
-                messages.append({"role": "assistant", "content": self._serialize_content(response.content)})
-
-                tool_results = []
-                for tool_block in tool_blocks:
-                    tool_name = tool_block.name
-                    tool_input = tool_block.input
-                    tool_use_id = tool_block.id
-
-                    if tool_name in approval_list:
-                        logger.info("Инструмент '%s' требует подтверждения", tool_name)
-
-                        # Добавляем tool_results для ВСЕХ tool_use блоков:
-                        # уже обработанные + placeholder для approval + заглушки для остальных
-                        all_results = list(tool_results)
-                        current_idx = tool_blocks.index(tool_block)
-                        # Placeholder для approval tool (заменится в execute_approved_tool)
-                        all_results.append({
-                            "type": "tool_result",
-                            "tool_use_id": tool_use_id,
-                            "content": "[ожидание подтверждения]",
-                        })
-                        # Заглушки для ещё не обработанных tools после approval
-                        for remaining in tool_blocks[current_idx + 1:]:
-                            all_results.append({
-                                "type": "tool_result",
-                                "tool_use_id": remaining.id,
-                                "content": "[пропущено — ожидание подтверждения другого инструмента]",
-                            })
-                        messages.append({"role": "user", "content": all_results})
-
-                        await save_message(self.db, project_id, "user", json.dumps(user_message))
-                        await track_cost(self.db, project_id, model, total_input, total_output)
-
-                        return AgentResponse(
-                            text=self._extract_text(response),
-                            tool_calls_count=tool_calls_count,
-                            tokens_input=total_input,
-                            tokens_output=total_output,
-                            model=model,
-                            pending_approval=PendingApproval(
-                                tool_name=tool_name,
-                                tool_input=tool_input,
-                                tool_use_id=tool_use_id,
-                                messages_snapshot=messages,
-                            ),
-                        )
-
-                    tool_calls_count += 1
-                    start = time.monotonic()
-                    try:
-                        result_text = await self.mcp.call_tool(tool_name, tool_input, project_id=project_id)
-                        latency = int((time.monotonic() - start) * 1000)
-                        await log_tool_call(
-                            self.db, project_id, tool_name, tool_input,
-                            result_text, model, latency_ms=latency,
-                        )
-                    except Exception as e:
-                        latency = int((time.monotonic() - start) * 1000)
-                        error_msg = f"Ошибка: {e}"
-                        await log_tool_call(
-                            self.db, project_id, tool_name, tool_input,
-                            error_msg, model, latency_ms=latency, is_error=True,
-                        )
-                        result_text = error_msg
-
-                    # Обрезаем результат чтобы не раздувать контекст
-                    truncated = self._truncate_tool_result(result_text, tool_name=tool_name)
+                serialized, tool_blocks, turn_text = self._split_content(response.content)
+                if not tool_blocks:
+                    # stop_reason=tool_use без tool_use блоков — продолжать нечего
+                    logger.warning("stop_reason=tool_use без tool_use блоков, завершаем цикл")
+                    text = turn_text
+                    break
+                partial_text = turn_text
+                messages.append({"role": "assistant", "content": serialized})
+
+                approval_idx = next(
+                    (i for i, b in enumerate(tool_blocks) if b.name in approval_list),
+                    None,
+                )
+                if approval_idx is None:
+                    tool_calls_count += len(tool_blocks)
+                    tool_results = await self._execute_tool_blocks(
+                        project_id, model, tool_blocks,
+                    )
+                    messages.append({"role": "user", "content": tool_results})
+                    est_delta = estimate_messages_tokens(messages[-2:])
+                    est_msgs += est_delta
+
+                    # Тримим messages если раздулись (сохраняем первое + последние)
+                    trimmed = trim_messages(messages)
+                    if trimmed is not messages:
+                        messages = trimmed
+                        est_msgs = estimate_messages_tokens(messages)
+                    continue
+
+                # Есть инструмент, требующий подтверждения: инструменты до него
+                # выполняем (параллельно, если разрешено), остальные откладываем
+                tool_calls_count += approval_idx
+                tool_results = await self._execute_tool_blocks(
+                    project_id, model, tool_blocks[:approval_idx],
+                )
+
+                approval_block = tool_blocks[approval_idx]
+                logger.info("Инструмент '%s' требует подтверждения", approval_block.name)
+
+                # Добавляем tool_results для ВСЕХ tool_use блоков:
+                # уже обработанные + placeholder для approval + заглушки для остальных
+                # Placeholder для approval tool (заменится в execute_approved_tool)
+                tool_results.append({
+                    "type": "tool_result",
+                    "tool_use_id": approval_block.id,
+                    "content": "[ожидание подтверждения]",
+                })
+                # Заглушки для ещё не обработанных tools после approval
+                for remaining in tool_blocks[approval_idx + 1:]:
                     tool_results.append({
                         "type": "tool_result",
-                        "tool_use_id": tool_use_id,
-                        "content": truncated,
+                        "tool_use_id": remaining.id,
+                        "content": "[пропущено — ожидание подтверждения другого инструмента]",
                     })
-
                 messages.append({"role": "user", "content": tool_results})
 
-                # Тримим messages если раздулись (сохраняем первое + последние)
-                messages = trim_messages(messages)
-                continue
+                # Ответ ассистента сохранится в execute_approved_tool
+                await save_message(self.db, project_id, "user", user_message)
+                self._track_cost_background(
+                    project_id, model, total_input, total_output,
+                    total_cache_read, total_cache_write,
+                )
+
+                return AgentResponse(
+                    text=turn_text,
+                    tool_calls_count=tool_calls_count,
+                    tokens_input=total_input,
+                    tokens_output=total_output,
+                    model=model,
+                    pending_approval=PendingApproval(
+                        tool_name=approval_block.name,
+                        tool_input=approval_block.input,
+                        tool_use_id=approval_block.id,
+                        messages_snapshot=messages,
+                    ),
+                )
 
             text = self._extract_text(response)
             break
@@ -315,23 +533,23 @@ class AgentCore:
             logger.warning("Достигнут лимит итераций (%d)", MAX_TOOL_ITERATIONS)
             response = await self._call_claude(
                 model=model, system=system_prompt,
-                messages=messages, tools=None,
+                messages=messages, tools=None, on_text=on_text,
             )
             total_input += response.usage.input_tokens
             total_output += response.usage.output_tokens
             text = self._extract_text(response) or "Достигнут лимит итераций."
 
         # 5. Сохраняем в БД
-        await save_message(self.db, project_id, "user", json.dumps(user_message))
-        await save_message(
-            self.db, project_id, "assistant", json.dumps(text),
-            tokens_input=total_input, tokens_output=total_output,
+        await self._save_turn(
+            project_id, model, user_message, text, total_input, total_output,
+            total_cache_read, total_cache_write,
         )
-        await track_cost(self.db, project_id, model, total_input, total_output)
 
         cache_stats = ""
         if total_cache_read or total_cache_write:
             cache_stats = f"cache read:{total_cache_read} write:{total_cache_write}"
+            if total_cache_write_1h or total_cache_write_5m:
+                cache_stats += f" (1h:{total_cache_write_1h} 5m:{total_cache_write_5m})"
             logger.info("Prompt cache: %s", cache_stats)
 
         return AgentResponse(
@@ -343,19 +561,38 @@ class AgentCore:
             cache_stats=cache_stats,
         )
 
+    async def _classifier_answer(
+        self,
+        project_id: str,
+        user_message: str,
+        classification: RequestClassification,
+    ) -> AgentResponse:
+        """Вернуть готовый ответ классификатора (small talk) как ответ агента."""
+        await self._save_turn(
+            project_id, CLASSIFIER_MODEL, user_message, classification.answer,
+            classification.tokens_input, classification.tokens_output,
+        )
+        return AgentResponse(
+            text=classification.answer, model=CLASSIFIER_MODEL,
+            tokens_input=classification.tokens_input,
+            tokens_output=classification.tokens_output,
+        )
+
     async def _simple_response(
-        self, project_id: str, project, user_message: str, phase: str,
+        self,
+        project_id: str,
+        user_message: str,
+        system_prompt: str,
+        history: list[tuple[str, str]],
+        on_text: TextCallback | None = None,
     ) -> AgentResponse:
         """Быстрый ответ на простой запрос через Haiku без tools.
 
         Экономия: Haiku ($1/M vs $3/M) + нет tool definitions (~2000 токенов меньше).
+        history — уже прочитанный из БД минимум истории для контекста.
         """
-        connected = self._get_connected_services(project_id)
-        system_prompt = build_system_prompt(project_id, project, phase, connected)
         model = "claude-haiku-4-5"
 
-        # Берём минимум истории для контекста
-        history = await get_conversation_history(self.db, project_id, limit=6)
         messages = build_messages_from_history(history)
         messages.append({"role": "user", "content": user_message})
 
@@ -364,18 +601,15 @@ class AgentCore:
             system=system_prompt,
             messages=messages,
             tools=None,
+            on_text=on_text,
         )
 
         text = self._extract_text(response)
 
-        await save_message(self.db, project_id, "user", json.dumps(user_message))
-        await save_message(
-            self.db, project_id, "assistant", json.dumps(text),
-            tokens_input=response.usage.input_tokens,
-            tokens_output=response.usage.output_tokens,
+        await self._save_turn(
+            project_id, model, user_message, text,
+            response.usage.input_tokens, response.usage.output_tokens,
         )
-        await track_cost(self.db, project_id, model,
-                         response.usage.input_tokens, response.usage.output_tokens)
 
         return AgentResponse(
             text=text, model=model,
@@ -387,29 +621,21 @@ class AgentCore:
         self,
         project_id: str,
         approval: PendingApproval,
+        on_text: TextCallback | None = None,
     ) -> AgentResponse:
-        """Выполнить инструмент после подтверждения и продолжить цикл агента."""
+        """Выполнить инструмент после подтверждения и продолжить цикл агента.
+
+        on_text — как в run(): стриминг текста ответа Claude.
+        """
         model = self.settings.global_config.default_model
-        messages = approval.messages_snapshot
+        # Snapshot не мутируем: новый список разделяет с ним все сообщения,
+        # кроме заменяемого (копия ссылок, без deepcopy истории)
+        messages = list(approval.messages_snapshot)
 
         # Фаза 1: вызов MCP-инструмента
-        tool_ok = False
-        start = time.monotonic()
-        try:
-            result_text = await self.mcp.call_tool(approval.tool_name, approval.tool_input, project_id=project_id)
-            latency = int((time.monotonic() - start) * 1000)
-            tool_ok = True
-            await log_tool_call(
-                self.db, project_id, approval.tool_name, approval.tool_input,
-                result_text, model, latency_ms=latency,
-            )
-        except Exception as e:
-            latency = int((time.monotonic() - start) * 1000)
-            result_text = f"Ошибка: {e}"
-            await log_tool_call(
-                self.db, project_id, approval.tool_name, approval.tool_input,
-                result_text, model, latency_ms=latency, is_error=True,
-            )
+        result_text, tool_ok = await self._call_and_log_tool(
+            project_id, model, approval.tool_name, approval.tool_input,
+        )
 
         # Заменяем placeholder в последнем user-сообщении (tool_results)
         truncated_result = self._truncate_tool_result(result_text, tool_name=approval.tool_name)
@@ -417,9 +643,11 @@ class AgentCore:
         if messages and messages[-1].get("role") == "user":
             content = messages[-1].get("content", [])
             if isinstance(content, list):
-                for item in content:
+                for i, item in enumerate(content):
                     if isinstance(item, dict) and item.get("tool_use_id") == approval.tool_use_id:
-                        item["content"] = truncated_result
+                        new_content = list(content)
+                        new_content[i] = {**item, "content": truncated_result}
+                        messages[-1] = {**messages[-1], "content": new_content}
                         replaced = True
                         break
         if not replaced:
@@ -436,10 +664,8 @@ class AgentCore:
         # Фаза 2: получаем ответ Claude и продолжаем tool loop если нужно
         try:
             project = self.settings.projects[project_id]
-            connected = self._get_connected_services(project_id)
-            system_prompt = build_system_prompt(project_id, project, project.phase, connected)
-            project_tools = self.mcp.get_project_tools(project_id)
-            anthropic_tools = mcp_tools_to_anthropic(project_tools)
+            system_prompt = self._get_system_prompt(project_id, project)
+            anthropic_tools, _ = self._get_anthropic_tools(project_id, project)
 
             total_input = 0
             total_output = 0
@@ -452,6 +678,7 @@ class AgentCore:
                     system=system_prompt,
                     messages=messages,
                     tools=anthropic_tools if anthropic_tools else None,
+                    on_text=on_text,
                 )
                 total_input += response.usage.input_tokens
                 total_output += response.usage.output_tokens
@@ -460,30 +687,22 @@ class AgentCore:
                     break
 
                 # Claude хочет вызвать ещё tools — продолжаем цикл
-                tool_blocks = [b for b in response.content if b.type == "tool_use"]
-                messages.append({"role": "assistant", "content": self._serialize_content(response.content)})
-                post_results = []
-                for tb in tool_blocks:
-                    tool_calls_count += 1
-                    start = time.monotonic()
-                    try:
-                        res = await self.mcp.call_tool(tb.name, tb.input, project_id=project_id)
-                        latency = int((time.monotonic() - start) * 1000)
-                        await log_tool_call(self.db, project_id, tb.name, tb.input, res, model, latency_ms=latency)
-                    except Exception as e:
-                        latency = int((time.monotonic() - start) * 1000)
-                        res = f"Ошибка: {e}"
-                        await log_tool_call(self.db, project_id, tb.name, tb.input, res, model, latency_ms=latency, is_error=True)
-                    post_results.append({"type": "tool_result", "tool_use_id": tb.id, "content": self._truncate_tool_result(res, tool_name=tb.name)})
+                serialized, tool_blocks, _ = self._split_content(response.content)
+                if not tool_blocks:
+                    logger.warning("stop_reason=tool_use без tool_use блоков, завершаем цикл")
+                    break
+                messages.append({"role": "assistant", "content": serialized})
+                tool_calls_count += len(tool_blocks)
+                post_results = await self._execute_tool_blocks(project_id, model, tool_blocks)
                 messages.append({"role": "user", "content": post_results})
 
             text = self._extract_text(response)
 
             await save_message(
-                self.db, project_id, "assistant", json.dumps(text),
+                self.db, project_id, "assistant", text,
                 tokens_input=total_input, tokens_output=total_output,
             )
-            await track_cost(self.db, project_id, model, total_input, total_output)
+            self._track_cost_background(project_id, model, total_input, total_output)
 
             return AgentResponse(
                 text=text,
@@ -500,49 +719,174 @@ class AgentCore:
                 return AgentResponse(text=fallback, tool_calls_count=1, model=model)
             raise
 
+    async def _save_turn(
+        self, project_id: str, model: str, user_message: str, text: str,
+        tokens_input: int, tokens_output: int,
+        cache_read: int = 0, cache_write: int = 0,
+    ) -> None:
+        """Сохранить пару user/assistant одной транзакцией, расходы — в фоне."""
+        await save_messages_batch(self.db, project_id, [
+            ("user", user_message, 0, 0),
+            ("assistant", text, tokens_input, tokens_output),
+        ])
+        self._track_cost_background(
+            project_id, model, tokens_input, tokens_output, cache_read, cache_write,
+        )
+
+    def _track_cost_background(
+        self, project_id: str, model: str, tokens_input: int, tokens_output: int,
+        cache_read: int = 0, cache_write: int = 0,
+    ) -> None:
+        """Учесть расходы в фоне — пользователь не ждёт записи в cost_tracking."""
+        task = asyncio.create_task(
+            track_cost(
+                self.db, project_id, model, tokens_input, tokens_output,
+                cache_read, cache_write,
+            ),
+        )
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._on_bg_task_done)
+
+    def _on_bg_task_done(self, task: asyncio.Task) -> None:
+        self._bg_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error("Ошибка фоновой задачи: %s", task.exception())
+
+    async def _call_and_log_tool(
+        self, project_id: str, model: str, tool_name: str, tool_input: dict[str, Any],
+    ) -> tuple[str, bool]:
+        """Вызвать MCP-инструмент и залогировать вызов. Возвращает (текст, успех)."""
+        result_text, ok, row = await self._call_tool(project_id, model, tool_name, tool_input)
+        await log_tool_call(self.db, *row)
+        return result_text, ok
+
+    async def _call_tool(
+        self, project_id: str, model: str, tool_name: str, tool_input: dict[str, Any],
+    ) -> tuple[str, bool, tuple]:
+        """Вызвать MCP-инструмент без записи в БД.
+
+        Возвращает (текст, успех, строка для tool_calls — см. tool_call_row).
+        Ошибки инструмента не пробрасываются — возвращаются текстом,
+        чтобы Claude мог на них отреагировать. Ответ MCP ограничивается
+        уже при чтении (с запасом относительно лимита обрезки), чтобы
+        многомегабайтные выдачи не копировались дальше целиком.
+        """
+        read_limit = self._tool_result_limit(tool_name) * TOOL_RESULT_READ_FACTOR
+        start = time.monotonic()
+        try:
+            result_text = await self.mcp.call_tool(
+                tool_name, tool_input, project_id=project_id, max_chars=read_limit,
+            )
+            ok = True
+        except Exception as e:
+            result_text = f"Ошибка: {e}"
+            ok = False
+        latency = int((time.monotonic() - start) * 1000)
+        row = tool_call_row(
+            project_id, tool_name, tool_input, result_text, model,
+            latency_ms=latency, is_error=not ok,
+        )
+        return result_text, ok, row
+
+    async def _invoke_tool(
+        self, project_id: str, model: str, tool_name: str, tool_input: dict[str, Any],
+    ) -> tuple[str, tuple]:
+        """Вызвать MCP-инструмент и обрезать результат. Возвращает (текст, строка лога)."""
+        result_text, _, row = await self._call_tool(project_id, model, tool_name, tool_input)
+        # Обрезаем результат чтобы не раздувать контекст
+        return self._truncate_tool_result(result_text, tool_name=tool_name), row
+
+    async def _execute_tool_blocks(
+        self, project_id: str, model: str, tool_blocks: list,
+    ) -> list[dict[str, Any]]:
+        """Выполнить tool_use блоки одного ответа Claude, вернуть tool_results.
+
+        Если разрешено настройками — блоки выполняются параллельно
+        (latency = max, а не сумма). Порядок результатов совпадает
+        с порядком tool_use блоков.
+        """
+        gc = self.settings.global_config
+        # Параллельно — только без общих мутаций: все блоки из allow-list
+        safe = tuple(gc.safe_parallel_tools) or READ_TOOL_PREFIXES
+        parallel = (
+            gc.parallel_tools
+            and len(tool_blocks) > 1
+            and all(b.name.startswith(safe) for b in tool_blocks)
+        )
+        if parallel:
+            logger.info("Параллельный вызов %d инструментов", len(tool_blocks))
+            results = await asyncio.gather(*(
+                self._invoke_tool(project_id, model, b.name, b.input)
+                for b in tool_blocks
+            ))
+        else:
+            results = [
+                await self._invoke_tool(project_id, model, b.name, b.input)
+                for b in tool_blocks
+            ]
+        # Логи всех вызовов пишутся после MCP-вызовов одним executemany + commit
+        await log_tool_calls(self.db, [row for _, row in results])
+        return [
+            {"type": "tool_result", "tool_use_id": b.id, "content": text}
+            for b, (text, _) in zip(tool_blocks, results)
+        ]
+
     async def _call_claude(
         self,
         model: str,
         system: str,
         messages: list[dict[str, Any]],
         tools: list[dict[str, Any]] | None = None,
+        max_tokens: int | None = None,
+        on_text: TextCallback | None = None,
     ) -> anthropic.types.Message:
-        """Вызвать Claude Messages API с prompt caching."""
+        """Вызвать Claude Messages API с prompt caching.
+
+        С on_text ответ стримится (см. _create_message), результат тот же Message.
+        """
         # === Оптимизация 2: Prompt Caching ===
         # System prompt кешируется — повторные запросы платят 10% за кешированную часть
-        system_with_cache = [{
-            "type": "text",
-            "text": system,
-            "cache_control": {"type": "ephemeral"},
-        }]
-
+        # Длинный TTL (1h) переживает паузы между сообщениями пользователя
+        # Текущее время идёт отдельным блоком после breakpoint: оно меняется
+        # каждую минуту и не должно сбивать кешированный префикс
+        gc = self.settings.global_config
+        system_with_cache = [
+            {
+                "type": "text",
+                "text": system,
+                "cache_control": {"type": "ephemeral", "ttl": gc.cache_ttl_long},
+            },
+            {"type": "text", "text": build_time_context()},
+        ]
+
+        # История тоже кешируется: breakpoints на последних user-сообщениях
+        # (граница диалога), в пределах лимита — system и tools уже заняли свои
+        history_breakpoints = MAX_CACHE_BREAKPOINTS - 1 - (1 if tools else 0)
         kwargs: dict[str, Any] = {
             "model": model,
-            "max_tokens": self.settings.global_config.max_tokens,
+            "max_tokens": max_tokens or gc.max_tokens,
             "system": system_with_cache,
-            "messages": messages,
+            "messages": add_cache_breakpoints(
+                messages, min(history_breakpoints, 2),
+                {"type": "ephemeral", "ttl": gc.cache_ttl_short},
+            ),
         }
 
         if tools:
-            # Кешируем и tools — они тоже повторяются
-            # cache_control на последнем tool — кеширует весь блок tools
-            cached_tools = list(tools)
-            if cached_tools:
-                cached_tools[-1] = {
-                    **cached_tools[-1],
-                    "cache_control": {"type": "ephemeral"},
-                }
-            kwargs["tools"] = cached_tools
+            # cache_control на последнем tool уже проставлен в _get_anthropic_tools
+            kwargs["tools"] = tools
 
         logger.info("→ API вызов: model=%s, max_tokens=%d, msgs=%d, tools=%s",
                     model, kwargs["max_tokens"], len(messages),
                     len(tools) if tools else 0)
 
+        await self._ensure_fresh_client()
+
         # Retry-логика поверх SDK: при 429/529 ждём дольше и пробуем ещё
         max_extra_retries = 3
         for attempt in range(max_extra_retries + 1):
             try:
-                result = await self.client.messages.create(**kwargs)
+                result = await self._create_message(kwargs, on_text)
                 logger.info("← API ответ: input=%d, output=%d, stop=%s",
                             result.usage.input_tokens, result.usage.output_tokens,
                             result.stop_reason)
@@ -553,7 +897,7 @@ class AgentCore:
                 # OAuth токен истёк — пробуем обновить и retry
                 logger.warning("← 401 AuthenticationError, пробуем refresh токена...")
                 await self._refresh_and_recreate_client()
-                result = await self.client.messages.create(**kwargs)
+                result = await self._create_message(kwargs, on_text)
                 logger.info("← API ответ (после refresh): input=%d, output=%d, stop=%s",
                             result.usage.input_tokens, result.usage.output_tokens,
                             result.stop_reason)
@@ -563,19 +907,15 @@ class AgentCore:
                 if attempt >= max_extra_retries:
                     logger.error("← 429 Rate Limit: все %d доп. попыток исчерпаны", max_extra_retries)
                     raise
-                # Берём retry-after из заголовков или ждём 15-30-60 сек
-                retry_after = None
-                if hasattr(e, "response") and e.response is not None:
-                    retry_after = e.response.headers.get("retry-after")
-                wait = int(retry_after) if retry_after else 15 * (2 ** attempt)
-                logger.warning("← 429 Rate Limit, попытка %d/%d, жду %d сек...",
+                wait = self._retry_wait(e, attempt)
+                logger.warning("← 429 Rate Limit, попытка %d/%d, жду %.1f сек...",
                                attempt + 1, max_extra_retries, wait)
                 await asyncio.sleep(wait)
                 continue
             except anthropic.APIStatusError as e:
                 if e.status_code == 529 and attempt < max_extra_retries:
-                    wait = 10 * (2 ** attempt)
-                    logger.warning("← 529 Overloaded, попытка %d/%d, жду %d сек...",
+                    wait = self._retry_wait(e, attempt)
+                    logger.warning("← 529 Overloaded, попытка %d/%d, жду %.1f сек...",
                                    attempt + 1, max_extra_retries, wait)
                     await asyncio.sleep(wait)
                     continue
@@ -585,12 +925,222 @@ class AgentCore:
                 logger.error("← API ошибка: %s", e)
                 raise
 
+    @staticmethod
+    def _retry_wait(error: anthropic.APIStatusError, attempt: int) -> float:
+        """Сколько ждать перед повтором после 429/529.
+
+        Приоритет: retry-after → ближайший anthropic-ratelimit-*-reset →
+        экспоненциальный backoff с jitter. Jitter разносит повторы
+        параллельных запросов, чтобы они не били в API одновременно.
+        """
+        headers = error.response.headers if error.response is not None else {}
+        retry_after = headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after) + random.uniform(0, RETRY_JITTER)
+            except ValueError:
+                pass
+
+        # Ждём сброса всех исчерпанных лимитов (remaining == 0)
+        now = datetime.now(UTC)
+        wait = 0.0
+        for kind in RATELIMIT_KINDS:
+            if headers.get(f"anthropic-ratelimit-{kind}-remaining") != "0":
+                continue
+            reset = headers.get(f"anthropic-ratelimit-{kind}-reset")
+            if not reset:
+                continue
+            try:
+                reset_at = datetime.fromisoformat(reset)
+            except ValueError:
+                continue
+            wait = max(wait, (reset_at - now).total_seconds())
+        if wait > 0:
+            return min(wait, RETRY_MAX_WAIT) + random.uniform(0, RETRY_JITTER)
+
+        return min(
+            RETRY_MAX_WAIT, random.uniform(RETRY_BASE_WAIT, RETRY_BASE_WAIT * 3 * 2 ** attempt),
+        )
+
+    async def _create_message(
+        self, kwargs: dict[str, Any], on_text: TextCallback | None,
+    ) -> anthropic.types.Message:
+        """Один запрос к Messages API: обычный или стриминговый.
+
+        При стриминге on_text получает накопленный текст не чаще
+        STREAM_UPDATE_INTERVAL и обязательно — в конце генерации.
+        """
+        if on_text is None:
+            return await self.client.messages.create(**kwargs)
+
+        parts: list[str] = []
+        sent = 0  # сколько дельт уже отдано в callback
+        last_update = time.monotonic()
+        async with self.client.messages.stream(**kwargs) as stream:
+            async for delta in stream.text_stream:
+                parts.append(delta)
+                now = time.monotonic()
+                if now - last_update >= STREAM_UPDATE_INTERVAL:
+                    last_update = now
+                    sent = len(parts)
+                    await self._notify_text(on_text, "".join(parts))
+            final = await stream.get_final_message()
+        if len(parts) > sent:
+            await self._notify_text(on_text, "".join(parts))
+        return final
+
+    @staticmethod
+    async def _notify_text(on_text: TextCallback, text: str) -> None:
+        """Вызвать callback стриминга; его ошибки не должны ронять запрос."""
+        try:
+            await on_text(text)
+        except Exception as e:
+            logger.debug("Ошибка callback стриминга: %s", e)
+
+    def _keep_warm(
+        self, project_id: str, model: str, system: str, tools: list[dict[str, Any]],
+    ) -> None:
+        """Запомнить префикс последнего хода и запустить heartbeat проекта."""
+        if not self.settings.global_config.cache_keepalive:
+            return
+        self._warm_prefix[project_id] = (model, system, tools)
+        self._last_activity[project_id] = time.monotonic()
+        task = self._heartbeats.get(project_id)
+        if task is None or task.done():
+            self._heartbeats[project_id] = asyncio.create_task(
+                self._heartbeat_loop(project_id),
+            )
+
+    async def _heartbeat_loop(self, project_id: str) -> None:
+        """Периодически обновлять prompt cache проекта, пока он активен.
+
+        Запрос минимальный (max_tokens=1), но с теми же tools и system, что
+        и реальный ход, — кеш по префиксу продлевается по цене чтения.
+        Время вынесено из кешируемого system в отдельный блок после
+        breakpoint (build_time_context), поэтому продлеваются оба блока —
+        и tools, и system.
+        """
+        gc = self.settings.global_config
+        ttl = CACHE_TTL_SECONDS.get(gc.cache_ttl_long, 300)
+        interval = ttl * KEEPALIVE_TTL_FRACTION
+        idle_limit = gc.cache_keepalive_idle_minutes * 60
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if time.monotonic() - self._last_activity.get(project_id, 0.0) > idle_limit:
+                    logger.info(
+                        "Keep-warm '%s': проект неактивен, heartbeat остановлен", project_id,
+                    )
+                    break
+                model, system, tools = self._warm_prefix[project_id]
+                try:
+                    response = await self._call_claude(
+                        model=model, system=system,
+                        messages=[{"role": "user", "content": "ping"}],
+                        tools=tools, max_tokens=1,
+                    )
+                except Exception as e:
+                    logger.warning("Keep-warm '%s': ошибка heartbeat: %s", project_id, e)
+                    continue
+                self._track_cost_background(
+                    project_id, model,
+                    response.usage.input_tokens, response.usage.output_tokens,
+                    getattr(response.usage, "cache_read_input_tokens", 0) or 0,
+                    getattr(response.usage, "cache_creation_input_tokens", 0) or 0,
+                )
+        finally:
+            self._heartbeats.pop(project_id, None)
+            self._warm_prefix.pop(project_id, None)
+
     async def _refresh_and_recreate_client(self) -> None:
         """Обновить OAuth токен и пересоздать Anthropic-клиент."""
-        await self._refresher.refresh()
-        self.client = self._create_client(self.settings)
+        await self._refresher.refresh(self._client_token)
+        self._recreate_client()
+
+    async def _ensure_fresh_client(self) -> None:
+        """Обновить токен заранее (если истекает) и подхватить токен из фонового refresh."""
+        if not self._refresher:
+            return
+        token = await self._refresher.get_token()
+        if token != self._client_token:
+            self._recreate_client()
+
+    def _recreate_client(self) -> None:
+        """Пересоздать Anthropic-клиент с текущим токеном из settings."""
+        self.client = self._create_client(self.settings, self._http_client)
+        self._client_token = self.settings.anthropic_auth_token
         logger.info("Anthropic-клиент пересоздан с новым токеном")
 
+    def _project_version(self, project: ProjectConfig) -> tuple:
+        """Ключ версии для кешей проекта.
+
+        Меняется при смене фазы (другая policy), набора mcp_services
+        и при любом запуске/остановке/переподключении MCP-инстанса.
+        """
+        return (project.phase, tuple(project.mcp_services), self.mcp.instances_version)
+
+    def _get_anthropic_tools(
+        self,
+        project_id: str,
+        project: ProjectConfig,
+        prefixes: tuple[str, ...] | None = None,
+    ) -> tuple[list[dict[str, Any]], int]:
+        """Инструменты проекта в формате Anthropic API (кешируются).
+
+        prefixes — фильтр по категориям от классификатора; если фильтр
+        ничего не оставил, возвращаются все инструменты проекта.
+        Возвращает (tools, общее число инструментов проекта).
+
+        Один и тот же список переиспользуется между запросами, поэтому
+        в API уходят байт-в-байт одинаковые tools — это важно для
+        совпадения префикса prompt cache. Список нельзя мутировать.
+        """
+        version = self._project_version(project)
+        key = (project_id, prefixes)
+        cached = self._tools_cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1], cached[2]
+
+        all_tools = self.mcp.get_project_tools(project_id)
+        project_tools = all_tools
+        if prefixes:
+            # str.startswith(tuple) проверяет все префиксы одним вызовом на C-уровне
+            project_tools = (
+                [t for t in all_tools if t["name"].startswith(prefixes)]
+                or all_tools  # fallback: все инструменты если фильтр пустой
+            )
+        total = len(all_tools)
+        tools = mcp_tools_to_anthropic(project_tools)
+        if tools:
+            # cache_control на последнем tool — кеширует весь блок tools
+            tools[-1] = {
+                **tools[-1],
+                "cache_control": {
+                    "type": "ephemeral",
+                    "ttl": self.settings.global_config.cache_ttl_long,
+                },
+            }
+
+        self._tools_cache[key] = (version, tools, total)
+        return tools, total
+
+    def _estimate_tools_tokens(self, tools: list[dict[str, Any]]) -> int:
+        """Оценка токенов tool definitions (мемоизируется по объекту списка).
+
+        Списки tools переиспользуются из _tools_cache, поэтому str() по всем
+        схемам считается один раз на версию набора инструментов.
+        """
+        if not tools:
+            return 0
+        cached = self._tools_tokens.get(id(tools))
+        if cached and cached[0] is tools:
+            return cached[1]
+        if len(self._tools_tokens) >= 64:
+            self._tools_tokens.clear()
+        estimate = sum(estimate_tokens(str(t)) for t in tools)
+        self._tools_tokens[id(tools)] = (tools, estimate)
+        return estimate
+
     def _get_available_categories(self, project_id: str) -> list[str]:
         """Определить доступные категории инструментов для проекта.
 
@@ -601,6 +1151,11 @@ class AgentCore:
         if not project:
             return []
 
+        version = self._project_version(project)
+        cached = self._categories_cache.get(project_id)
+        if cached and cached[0] == version:
+            return cached[1]
+
         categories: list[str] = []
         for instance_id in project.mcp_services:
             inst = self.settings.global_config.mcp_instances.get(instance_id)
@@ -609,8 +1164,18 @@ class AgentCore:
             meta = MCP_TYPE_META.get(inst.type)
             if meta and meta.category not in categories:
                 categories.append(meta.category)
+        self._categories_cache[project_id] = (version, categories)
         return categories
 
+    def _get_system_prompt(self, project_id: str, project: ProjectConfig) -> str:
+        """Системный промпт проекта.
+
+        Кешируется в build_system_prompt по параметрам сборки и mtime файла
+        промпта — правки в файле подхватываются сразу.
+        """
+        connected = self._get_connected_services(project_id)
+        return build_system_prompt(project_id, project, project.phase, connected)
+
     def _get_connected_services(self, project_id: str) -> list[str]:
         """Получить display_name реально запущенных MCP-сервисов для системного промпта.
 
@@ -621,6 +1186,11 @@ class AgentCore:
         if not project:
             return []
 
+        version = self._project_version(project)
+        cached = self._connected_cache.get(project_id)
+        if cached and cached[0] == version:
+            return cached[1]
+
         services: list[str] = []
         seen_types: set[str] = set()
         for instance_id in project.mcp_services:
@@ -634,42 +1204,63 @@ class AgentCore:
             if meta and inst.type.value not in seen_types:
                 seen_types.add(inst.type.value)
                 services.append(meta.display_name)
+        self._connected_cache[project_id] = (version, services)
         return services
 
-    @staticmethod
-    def _truncate_tool_result(text: str, max_chars: int = 0, *, tool_name: str = "") -> str:
+    def _tool_result_limit(self, tool_name: str) -> int:
+        """Лимит обрезки результата: per-tool из TOOL_RESULT_LIMITS или из настроек."""
+        return TOOL_RESULT_LIMITS.get(tool_name, self.settings.global_config.tool_result_max_chars)
+
+    def _truncate_tool_result(self, text: str, max_chars: int = 0, *, tool_name: str = "") -> str:
         """Обрезать результат инструмента для экономии токенов.
 
         Лимит выбирается по приоритету:
         1. Явный max_chars (если передан > 0)
         2. Per-tool лимит из TOOL_RESULT_LIMITS
-        3. DEFAULT_TOOL_RESULT_LIMIT (2000)
+        3. global.tool_result_max_chars (по умолчанию 2000)
+
+        Перед обрезкой результат дословно сжимается (compact_tool_result),
+        чтобы в лимит попало больше полезных строк.
         """
         if max_chars <= 0:
-            max_chars = TOOL_RESULT_LIMITS.get(tool_name, DEFAULT_TOOL_RESULT_LIMIT)
+            max_chars = self._tool_result_limit(tool_name)
+        original_len = len(text)
+        text = compact_tool_result(text, email=tool_name.startswith(EMAIL_TOOL_PREFIXES))
+        if len(text) < original_len:
+            logger.debug(
+                "Результат %s сжат: %d → %d символов", tool_name or "?", original_len, len(text),
+            )
         if len(text) <= max_chars:
             return text
         return text[:max_chars] + "\n...[обрезано]"
 
     @staticmethod
     def _extract_text(response: anthropic.types.Message) -> str:
-        parts = []
-        for block in response.content:
-            if block.type == "text":
-                parts.append(block.text)
-        return "\n".join(parts) if parts else ""
+        content = response.content
+        # Частый случай — единственный текстовый блок: без списка и join
+        if len(content) == 1 and content[0].type == "text":
+            return content[0].text
+        return "\n".join(b.text for b in content if b.type == "text")
 
     @staticmethod
-    def _serialize_content(content: list) -> list[dict[str, Any]]:
-        result = []
+    def _split_content(content: list) -> tuple[list[dict[str, Any]], list, str]:
+        """Разобрать content ответа за один проход.
+
+        Возвращает (блоки для messages, tool_use блоки, текст ответа).
+        """
+        serialized: list[dict[str, Any]] = []
+        tool_blocks = []
+        texts: list[str] = []
         for block in content:
             if block.type == "text":
-                result.append({"type": "text", "text": block.text})
+                serialized.append({"type": "text", "text": block.text})
+                texts.append(block.text)
             elif block.type == "tool_use":
-                result.append({
+                serialized.append({
                     "type": "tool_use",
                     "id": block.id,
                     "name": block.name,
                     "input": block.input,
                 })
-        return result
+                tool_blocks.append(block)
+        return serialized, tool_blocks, "\n".join(texts)
@@ -0,0 +1,85 @@
+"""Локальный классификатор запросов по ключевым словам (без вызова Haiku).
+
+Срабатывает только на явные упоминания сервисов ("письмо", "встреча",
+"jira"...). Если уверенности нет — возвращает None, и запрос уходит
+в Haiku-классификатор.
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+
+from src.agent.classifier import RequestClassification
+
+logger = logging.getLogger(__name__)
+
+# Признаки категорий: основы (совпадение с начала слова) и целые слова.
+# Основы — только длинные и однозначные русские; английские и короткие
+# ("mail", "tg", "wiki", "почта") — целыми словами, иначе "mailchimp",
+# "почти" или "википедия" отключали бы все остальные категории инструментов.
+# Общие слова вроде "событие" и "расписание" не учитываются — решает Haiku.
+_CATEGORY_KEYWORDS: dict[str, tuple[tuple[str, ...], tuple[str, ...]]] = {
+    "gmail": (
+        ("письм", "писем", "имейл", "почтов"),
+        ("почта", "почту", "почте", "почты", "почтой", "мейл", "мейлы",
+         "email", "emails", "e-mail", "gmail", "inbox", "mail"),
+    ),
+    "calendar": (
+        ("календар", "встреч", "созвон", "митинг"),
+        ("calendar", "meeting", "meetings"),
+    ),
+    "telegram": (
+        ("телеграм",),
+        ("телега", "телеге", "телегу", "telegram", "tg"),
+    ),
+    "whatsapp": (
+        ("ватсап", "вотсап", "воцап"),
+        ("whatsapp",),
+    ),
+    "slack": (
+        (),
+        ("slack", "слак", "слаке", "слака", "слэк", "слэке"),
+    ),
+    "confluence": (
+        ("конфлюенс",),
+        ("confluence", "вики", "wiki"),
+    ),
+    "jira": (
+        ("джир", "тикет"),
+        ("jira",),
+    ),
+}
+
+
+def _keywords_re(stems: tuple[str, ...], words: tuple[str, ...]) -> re.Pattern[str]:
+    parts = [re.escape(s) for s in stems]
+    if words:
+        parts.append(r"(?:" + "|".join(re.escape(w) for w in words) + r")\b")
+    return re.compile(r"\b(?:" + "|".join(parts) + r")", re.IGNORECASE)
+
+
+_CATEGORY_RE: dict[str, re.Pattern[str]] = {
+    category: _keywords_re(stems, words)
+    for category, (stems, words) in _CATEGORY_KEYWORDS.items()
+}
+
+
+def local_classify(
+    user_message: str, available_categories: list[str],
+) -> RequestClassification | None:
+    """Классифицировать запрос по ключевым словам.
+
+    Возвращает классификацию с инструментами, если упомянуты только
+    подключённые к проекту сервисы; None — если ключевых слов нет или
+    упомянут недоступный сервис (тогда решает Haiku).
+    """
+    matched = [
+        category for category, pattern in _CATEGORY_RE.items()
+        if pattern.search(user_message)
+    ]
+    if not matched or any(c not in available_categories for c in matched):
+        return None
+
+    logger.info("routing.decision source=local categories=%s", matched)
+    return RequestClassification(needs_tools=True, categories=matched, is_simple=False)
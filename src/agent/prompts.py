@@ -2,12 +2,21 @@
 
 from __future__ import annotations
 
-from datetime import datetime
+import os
+import time
 from pathlib import Path
 
 from src.mcp.types import MCP_TYPE_META, McpServerType
 from src.settings import PROJECT_ROOT, ProjectConfig
 
+# Кеш собранных промптов: ключ — входные параметры сборки,
+# значение — (mtime_ns файла промпта или None, промпт)
+_PROMPT_CACHE: dict[tuple, tuple[int | None, str]] = {}
+# Кеш содержимого файлов промптов: путь → (mtime_ns, текст)
+_PROMPT_FILE_CACHE: dict[Path, tuple[int, str]] = {}
+# Строка времени для текущей минуты: (номер минуты, строка)
+_TIME_CONTEXT_CACHE: tuple[int, str] = (-1, "")
+
 
 def build_system_prompt(
     project_id: str,
@@ -19,47 +28,91 @@ def build_system_prompt(
 
     connected_services — список display_name подключённых MCP-сервисов
     (например, ["Gmail", "Google Calendar", "Slack"]).
-    """
-    parts: list[str] = []
 
-    # 1. Базовый промпт из файла (поддержка относительных путей через PROJECT_ROOT)
+    Результат кешируется; файл промпта перечитывается только при смене mtime.
+    """
+    prompt_file: tuple[int, str] | None = None
     if project.system_prompt_file:
         prompt_path = Path(project.system_prompt_file)
         if not prompt_path.is_absolute():
             prompt_path = PROJECT_ROOT / prompt_path
-        if prompt_path.is_file():
-            parts.append(prompt_path.read_text().strip())
-        else:
-            parts.append(f"Ты — AI-ассистент для проекта '{project.display_name}'.")
-    else:
-        parts.append(f"Ты — AI-ассистент для проекта '{project.display_name}'.")
+        prompt_file = _read_prompt_file(prompt_path)
+    mtime = prompt_file[0] if prompt_file else None
 
-    # 2. Текущий контекст
-    parts.append(f"\n## Текущий контекст\n")
-    parts.append(f"- Дата и время: {datetime.now().strftime('%d.%m.%Y %H:%M')}")
-    parts.append(f"- Проект: {project.display_name} (ID: {project_id})")
-    parts.append(f"- Фаза: {phase}")
+    key = (
+        project_id, project.display_name, phase,
+        tuple(connected_services or ()), project.system_prompt_file,
+    )
+    cached = _PROMPT_CACHE.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
 
-    # 3. Подключённые сервисы (динамически из конфига)
+    # 1. Базовый промпт из файла (поддержка относительных путей через PROJECT_ROOT)
+    if prompt_file is not None:
+        base_prompt = prompt_file[1]
+    else:
+        base_prompt = f"Ты — AI-ассистент для проекта '{project.display_name}'."
+
+    # 2. Подключённые сервисы (динамически из конфига)
     if connected_services:
-        parts.append(f"\n## Подключённые сервисы\n")
-        parts.append("У тебя есть доступ к следующим сервисам:")
-        for svc in connected_services:
-            parts.append(f"- {svc}")
+        services_list = "\n".join(f"- {svc}" for svc in connected_services)
+        services_block = f"У тебя есть доступ к следующим сервисам:\n{services_list}"
     else:
-        parts.append(f"\n## Подключённые сервисы\n")
-        parts.append("К проекту не подключены MCP-сервисы.")
+        services_block = "К проекту не подключены MCP-сервисы."
 
-    # 4. Правила работы с почтой (если Gmail подключён)
+    # 3. Правила работы с почтой (если Gmail подключён)
+    email_rules = ""
     if connected_services and any("Gmail" in s for s in connected_services):
-        parts.append(_get_email_search_rules())
+        email_rules = f"\n{_get_email_search_rules()}"
+
+    # Текущий контекст без даты и времени (см. build_time_context):
+    # промпт кешируется в Anthropic, а кеш сравнивает префикс побайтно
+    prompt = (
+        f"{base_prompt}\n"
+        f"\n## Текущий контекст\n\n"
+        f"- Проект: {project.display_name} (ID: {project_id})\n"
+        f"- Фаза: {phase}\n"
+        f"\n## Подключённые сервисы\n\n"
+        f"{services_block}{email_rules}\n"
+        f"\n## Правила текущей фазы ({phase})\n\n"
+        f"{_get_phase_rules(phase)}"
+    )
+    _PROMPT_CACHE[key] = (mtime, prompt)
+    return prompt
 
-    # 5. Правила фазы
-    phase_rules = _get_phase_rules(phase)
-    parts.append(f"\n## Правила текущей фазы ({phase})\n")
-    parts.append(phase_rules)
 
-    return "\n".join(parts)
+def _read_prompt_file(path: Path) -> tuple[int, str] | None:
+    """Прочитать файл промпта: (mtime_ns, текст) или None, если файла нет.
+
+    Один os.stat на вызов; файл перечитывается только при смене mtime.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    cached = _PROMPT_FILE_CACHE.get(path)
+    if cached and cached[0] == st.st_mtime_ns:
+        return cached
+    try:
+        text = path.read_text("utf-8", errors="replace").strip()
+    except OSError:
+        return None
+    entry = (st.st_mtime_ns, text)
+    _PROMPT_FILE_CACHE[path] = entry
+    return entry
+
+
+def build_time_context() -> str:
+    """Текущие дата и время — отдельный блок system после кешируемого промпта.
+
+    Точность — минута, поэтому строка форматируется раз в минуту.
+    """
+    global _TIME_CONTEXT_CACHE
+    minute = int(time.time() // 60)
+    if _TIME_CONTEXT_CACHE[0] != minute:
+        now = time.strftime("%d.%m.%Y %H:%M", time.localtime(minute * 60))
+        _TIME_CONTEXT_CACHE = (minute, f"Текущие дата и время: {now}")
+    return _TIME_CONTEXT_CACHE[1]
 
 
 def _get_email_search_rules() -> str:
@@ -94,26 +147,33 @@ def _get_email_search_rules() -> str:
     )
 
 
+_PHASE_RULES: dict[str, str] = {
+    "read_only": (
+        "- Можно ТОЛЬКО читать данные: искать email, читать сообщения, просматривать календарь\n"
+        "- НЕЛЬЗЯ отправлять, удалять, создавать что-либо\n"
+        "- Если пользователь просит выполнить действие — объясни, что сейчас режим только чтения"
+    ),
+    "drafts": (
+        "- Можно читать данные и создавать черновики\n"
+        "- Создание черновиков и событий ТРЕБУЕТ подтверждения пользователя\n"
+        "- НЕЛЬЗЯ отправлять сообщения напрямую"
+    ),
+    "controlled": (
+        "- Доступны все действия\n"
+        "- Отправка email, удаление, отправка сообщений ТРЕБУЮТ подтверждения\n"
+        "- Чтение и поиск выполняются автоматически"
+    ),
+}
+
+# Строки возможностей для шаблона промпта по типу MCP-сервера
+_CAPABILITY_BY_TYPE: dict[McpServerType, str] = {
+    stype: f"- {meta.capability_description}" for stype, meta in MCP_TYPE_META.items()
+}
+
+
 def _get_phase_rules(phase: str) -> str:
     """Получить текстовое описание правил для фазы."""
-    rules = {
-        "read_only": (
-            "- Можно ТОЛЬКО читать данные: искать email, читать сообщения, просматривать календарь\n"
-            "- НЕЛЬЗЯ отправлять, удалять, создавать что-либо\n"
-            "- Если пользователь просит выполнить действие — объясни, что сейчас режим только чтения"
-        ),
-        "drafts": (
-            "- Можно читать данные и создавать черновики\n"
-            "- Создание черновиков и событий ТРЕБУЕТ подтверждения пользователя\n"
-            "- НЕЛЬЗЯ отправлять сообщения напрямую"
-        ),
-        "controlled": (
-            "- Доступны все действия\n"
-            "- Отправка email, удаление, отправка сообщений ТРЕБУЮТ подтверждения\n"
-            "- Чтение и поиск выполняются автоматически"
-        ),
-    }
-    return rules.get(phase, rules["read_only"])
+    return _PHASE_RULES.get(phase, _PHASE_RULES["read_only"])
 
 
 def generate_default_prompt_file(
@@ -137,11 +197,9 @@ def generate_default_prompt_file(
         if calendar:
             enabled_types.append(McpServerType.calendar)
 
-    capabilities: list[str] = []
-    for stype in enabled_types:
-        meta = MCP_TYPE_META.get(stype)
-        if meta:
-            capabilities.append(f"- {meta.capability_description}")
+    capabilities = [
+        _CAPABILITY_BY_TYPE[stype] for stype in enabled_types if stype in _CAPABILITY_BY_TYPE
+    ]
     capabilities.append("- Форматирование ответов для удобного чтения в Telegram")
 
     cap_block = "\n".join(capabilities)
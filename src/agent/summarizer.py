@@ -2,14 +2,20 @@
 
 from __future__ import annotations
 
-import json
+import asyncio
 import logging
-from typing import Any
+from collections.abc import Callable
+from itertools import pairwise
+from typing import TYPE_CHECKING, Any
 
 import anthropic
 
+from src.agent.context import SUMMARY_PREFIX, estimate_messages_tokens
 from src.db.database import Database
 
+if TYPE_CHECKING:
+    from src.agent.batch_summarizer import BatchSummarizer
+
 logger = logging.getLogger(__name__)
 
 SUMMARIZER_MODEL = "claude-haiku-4-5"
@@ -17,6 +23,25 @@ SUMMARIZER_MODEL = "claude-haiku-4-5"
 SUMMARIZE_THRESHOLD = 20
 # Сколько последних сообщений оставляем как есть
 KEEP_RECENT = 10
+# Сколько сообщений может накопиться после сохранённого резюме Haiku,
+# прежде чем оно будет пересчитано (до этого резюме переиспользуется)
+SUMMARY_REFRESH_MESSAGES = 10
+# Бюджет истории в токенах (совпадает с лимитом trim_messages) и доли от него:
+# ниже HEURISTIC_RATIO история остаётся дословной, до LLM_RATIO — шаблонное
+# резюме без вызова модели, выше — резюме от Haiku
+CONTEXT_BUDGET_TOKENS = 4_000
+HEURISTIC_RATIO = 0.8
+LLM_RATIO = 0.95
+# Сколько последних тем (первых строк запросов) попадает в шаблонное резюме
+HEURISTIC_MAX_TOPICS = 5
+HEURISTIC_TOPIC_CHARS = 80
+# Максимальная длина одного сообщения в тексте для Haiku
+SUMMARY_MESSAGE_CHARS = 500
+# Не больше стольких одновременных фоновых записей резюме в БД
+_PERSIST_CONCURRENCY = 4
+_persist_semaphore = asyncio.Semaphore(_PERSIST_CONCURRENCY)
+# Фоновые записи резюме — держим ссылки, чтобы задачи не собрал GC
+_persist_tasks: set[asyncio.Task] = set()
 
 SUMMARIZE_PROMPT = """Сожми следующую историю разговора в краткое резюме на русском языке.
 ОБЯЗАТЕЛЬНО сохрани:
@@ -35,53 +60,92 @@ async def maybe_summarize(
     db: Database,
     project_id: str,
     messages: list[dict[str, Any]],
+    batch: BatchSummarizer | None = None,
 ) -> list[dict[str, Any]]:
-    """Если сообщений больше порога — сжать старые в summary.
+    """Если история близка к бюджету токенов — сжать старые сообщения в summary.
 
     Возвращает новый список messages:
     [summary_message] + [последние KEEP_RECENT сообщений]
 
-    Стоимость одного сжатия: ~2K input + ~200 output = ~$0.003
+    До HEURISTIC_RATIO бюджета история не меняется, до LLM_RATIO —
+    шаблонное резюме (_heuristic_summary), выше — резюме от Haiku.
+    Стоимость одного сжатия Haiku: ~2K input + ~200 output = ~$0.003
+
+    С batch сжатие не блокирует ход: задача уходит в очередь Batches API,
+    а до готовности резюме используется шаблонное (по всем старым сообщениям).
+
+    Резюме Haiku сохраняется в БД вместе с id последнего сжатого сообщения
+    и переиспользуется, пока после него не накопится больше
+    KEEP_RECENT + SUMMARY_REFRESH_MESSAGES сообщений: сообщения после
+    резюме передаются дословно. Так Haiku не вызывается на каждом ходе,
+    а префикс истории остаётся стабильным для prompt cache.
     """
     if len(messages) < SUMMARIZE_THRESHOLD:
         return messages
 
+    tokens = estimate_messages_tokens(messages)
+    if tokens < CONTEXT_BUDGET_TOKENS * HEURISTIC_RATIO:
+        return messages
+
+    use_llm = tokens >= CONTEXT_BUDGET_TOKENS * LLM_RATIO
+    summary: str | None = None
+    keep = KEEP_RECENT
+    if use_llm:
+        stored = await _get_fresh_summary(db, project_id)
+        if stored is not None and stored[1] < len(messages):
+            summary, keep = stored
+            logger.info(
+                "Переиспользуем сохранённое резюме проекта '%s' (+%d сообщений после него)",
+                project_id, keep,
+            )
+
     # Разделяем: старые (для сжатия) и свежие (оставляем)
-    old_messages = messages[:-KEEP_RECENT]
-    recent_messages = messages[-KEEP_RECENT:]
+    old_messages = messages[:-keep] if keep else messages
+    recent_messages = messages[-keep:] if keep else []
 
     logger.info(
-        "Сжатие истории проекта '%s': %d старых → summary, %d свежих сохраняем",
-        project_id, len(old_messages), len(recent_messages),
+        "Сжатие истории проекта '%s' (~%d tokens, %s): %d старых → summary, %d свежих сохраняем",
+        project_id, tokens, "llm" if use_llm else "heuristic",
+        len(old_messages), len(recent_messages),
     )
 
-    # Форматируем старые сообщения для Haiku
-    history_text = _format_messages_for_summary(old_messages)
-
-    try:
-        response = await client.messages.create(
-            model=SUMMARIZER_MODEL,
-            max_tokens=500,
-            system=SUMMARIZE_PROMPT,
-            messages=[{"role": "user", "content": history_text}],
+    if use_llm and summary is None:
+        # Форматируем старые сообщения для Haiku
+        history_text = _format_messages_for_summary(old_messages)
+        # История в messages совпадает с последними строками conversations
+        # (новое сообщение пользователя ещё не сохранено)
+        row = await db.fetchone(
+            "SELECT id FROM conversations WHERE project_id = ? "
+            "ORDER BY id DESC LIMIT 1 OFFSET ?",
+            (project_id, keep),
         )
-        summary = response.content[0].text.strip()
-    except Exception:
-        logger.exception("Ошибка при сжатии истории, возвращаем как есть")
-        return messages
-
-    # Сохраняем summary в БД
-    await db.execute(
-        "INSERT INTO conversation_summaries (project_id, summary, messages_start_id, messages_end_id) "
-        "VALUES (?, ?, 0, 0)",
-        (project_id, summary),
-    )
-    await db.commit()
+        messages_end_id = row["id"] if row else 0
+
+        if batch is not None:
+            # Резюме будет сохранено с messages_end_id и подхвачено
+            # _get_fresh_summary на следующих ходах
+            await batch.enqueue(project_id, history_text, messages_end_id)
+        else:
+            try:
+                response = await client.messages.create(**summary_request_params(history_text))
+                summary = response.content[0].text.strip()
+            except Exception:
+                logger.exception("Ошибка при сжатии истории, используем шаблонное резюме")
+            else:
+                # Запись резюме — производные данные: ход её не ждёт
+                task = asyncio.create_task(
+                    _persist_summary(db, project_id, summary, messages_end_id),
+                )
+                _persist_tasks.add(task)
+                task.add_done_callback(_persist_tasks.discard)
+
+    if summary is None:
+        summary = _heuristic_summary(old_messages)
 
     # Собираем новый список: summary как user-сообщение + свежие
     summary_message = {
         "role": "user",
-        "content": f"[Краткое резюме предыдущего разговора]\n{summary}\n[Конец резюме, продолжаем разговор]",
+        "content": f"{SUMMARY_PREFIX}\n{summary}\n[Конец резюме, продолжаем разговор]",
     }
 
     # Нужно чтобы первое сообщение после summary было от assistant
@@ -101,6 +165,66 @@ async def maybe_summarize(
     return result
 
 
+def summary_request_params(history_text: str) -> dict[str, Any]:
+    """Параметры запроса к Haiku на сжатие (общие для обычного и batch-режима)."""
+    return {
+        "model": SUMMARIZER_MODEL,
+        "max_tokens": 500,
+        "system": SUMMARIZE_PROMPT,
+        "messages": [{"role": "user", "content": history_text}],
+    }
+
+
+async def save_summary(
+    db: Database, project_id: str, summary: str, messages_end_id: int = 0,
+) -> None:
+    """Сохранить резюме истории проекта в БД.
+
+    messages_end_id — id последнего сжатого сообщения; 0 — неизвестен
+    (такое резюме не переиспользуется в _get_fresh_summary).
+    """
+    await db.execute(
+        "INSERT INTO conversation_summaries "
+        "(project_id, summary, messages_start_id, messages_end_id) "
+        "VALUES (?, ?, 0, ?)",
+        (project_id, summary, messages_end_id),
+    )
+    await db.commit()
+
+
+async def _persist_summary(
+    db: Database, project_id: str, summary: str, messages_end_id: int,
+) -> None:
+    """Фоновая запись резюме; ошибка только логируется (резюме пересчитается)."""
+    async with _persist_semaphore:
+        try:
+            await save_summary(db, project_id, summary, messages_end_id)
+        except Exception:
+            logger.exception("Не удалось сохранить резюме проекта '%s'", project_id)
+
+
+async def _get_fresh_summary(db: Database, project_id: str) -> tuple[str, int] | None:
+    """Последнее резюме Haiku, если после него мало новых сообщений.
+
+    Возвращает (резюме, число сообщений после него) или None.
+    """
+    row = await db.fetchone(
+        "SELECT summary, messages_end_id FROM conversation_summaries "
+        "WHERE project_id = ? AND messages_end_id > 0 ORDER BY id DESC LIMIT 1",
+        (project_id,),
+    )
+    if row is None:
+        return None
+    count = await db.fetchone(
+        "SELECT COUNT(*) FROM conversations WHERE project_id = ? AND id > ?",
+        (project_id, row["messages_end_id"]),
+    )
+    newer = count[0]
+    if newer > KEEP_RECENT + SUMMARY_REFRESH_MESSAGES:
+        return None
+    return row["summary"], newer
+
+
 async def get_previous_summary(db: Database, project_id: str) -> str | None:
     """Получить последнее сохранённое резюме для проекта."""
     row = await db.fetchone(
@@ -111,36 +235,83 @@ async def get_previous_summary(db: Database, project_id: str) -> str | None:
     return row["summary"] if row else None
 
 
-def _format_messages_for_summary(messages: list[dict[str, Any]]) -> str:
-    """Преобразовать сообщения в текст для summarization."""
-    parts = []
+def _heuristic_summary(messages: list[dict[str, Any]]) -> str:
+    """Шаблонное резюме без вызова модели: темы, инструменты, последняя ошибка."""
+    topics: list[str] = []
+    tools: list[str] = []
+    last_error = ""
     for msg in messages:
-        role = "Пользователь" if msg["role"] == "user" else "Ассистент"
         content = msg.get("content", "")
-        if isinstance(content, list):
-            # Извлекаем текст из блоков
-            texts = []
-            for block in content:
-                if isinstance(block, dict):
-                    if block.get("type") == "text":
-                        texts.append(block["text"])
-                    elif block.get("type") == "tool_result":
-                        texts.append(f"[Результат инструмента: {block.get('content', '')[:200]}]")
-                    elif block.get("type") == "tool_use":
-                        texts.append(f"[Вызов: {block.get('name', '?')}]")
-            content = "\n".join(texts)
-        if isinstance(content, str) and content:
-            # Обрезаем длинные сообщения
-            if len(content) > 500:
-                content = content[:500] + "..."
-            parts.append(f"{role}: {content}")
-    return "\n\n".join(parts)
+        if isinstance(content, str):
+            if msg["role"] == "user" and content.strip():
+                topics.append(content.strip().split("\n", 1)[0][:HEURISTIC_TOPIC_CHARS])
+            continue
+        for block in content:
+            if not isinstance(block, dict):
+                continue
+            block_type = block.get("type")
+            if block_type == "tool_use":
+                name = block.get("name", "?")
+                if name not in tools:
+                    tools.append(name)
+            elif block_type == "tool_result":
+                result = block.get("content", "")
+                if isinstance(result, str) and (
+                    block.get("is_error") or result.startswith("Ошибка")
+                ):
+                    last_error = result[:HEURISTIC_TOPIC_CHARS]
+            elif block_type == "text" and msg["role"] == "user" and block["text"].strip():
+                topics.append(block["text"].strip().split("\n", 1)[0][:HEURISTIC_TOPIC_CHARS])
+
+    parts = [f"{len(messages)} сообщений"]
+    if topics:
+        parts.append("темы: " + "; ".join(topics[-HEURISTIC_MAX_TOPICS:]))
+    if tools:
+        parts.append("инструменты: " + ", ".join(tools))
+    if last_error:
+        parts.append(f"последняя ошибка: {last_error}")
+    return "- " + "\n- ".join(parts)
+
+
+# Текстовое представление блоков контента по типу; остальные типы пропускаются
+_BLOCK_RENDERERS: dict[str, Callable[[dict[str, Any]], str]] = {
+    "text": lambda b: b["text"],
+    "tool_result": lambda b: f"[Результат инструмента: {b.get('content', '')[:200]}]",
+    "tool_use": lambda b: f"[Вызов: {b.get('name', '?')}]",
+}
+
+
+def _render_message(msg: dict[str, Any]) -> str | None:
+    """Одно сообщение для summarization: "Роль: текст" или None, если текста нет."""
+    content = msg.get("content", "")
+    if isinstance(content, list):
+        content = "\n".join(
+            render(block) for block in content
+            if isinstance(block, dict)
+            and (render := _BLOCK_RENDERERS.get(block.get("type"))) is not None
+        )
+    if not isinstance(content, str) or not content:
+        return None
+    if len(content) > SUMMARY_MESSAGE_CHARS:
+        content = f"{content[:SUMMARY_MESSAGE_CHARS]}..."
+    role = "Пользователь" if msg["role"] == "user" else "Ассистент"
+    return f"{role}: {content}"
+
+
+def _format_messages_for_summary(messages: list[dict[str, Any]]) -> str:
+    """Преобразовать сообщения в текст для summarization."""
+    return "\n\n".join(filter(None, map(_render_message, messages)))
 
 
 def _fix_role_alternation(messages: list[dict[str, Any]]) -> list[dict[str, Any]]:
     """Гарантировать чередование user/assistant в messages."""
     if not messages:
         return messages
+    # Быстрый путь: роли уже чередуются и первое — user (обычный случай)
+    if messages[0]["role"] == "user" and all(
+        a["role"] != b["role"] for a, b in pairwise(messages)
+    ):
+        return messages
 
     fixed = [messages[0]]
     for msg in messages[1:]:
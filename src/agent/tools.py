@@ -2,7 +2,6 @@
 
 from __future__ import annotations
 
-import copy
 from typing import Any
 
 # Лимит длины description для экономии токенов
@@ -47,16 +46,21 @@ def _minimize_schema(schema: dict[str, Any], *, keep_descriptions: bool = False)
     """Убрать лишние поля из input_schema для экономии токенов.
 
     keep_descriptions=True — сохранить description у параметров (для критичных tools).
+
+    Копируются только верхний уровень и изменяемые properties; вложенные
+    объекты общие с исходной схемой MCP, поэтому результат нельзя мутировать.
     """
-    schema = copy.deepcopy(schema)
-    if "type" not in schema:
-        schema["type"] = "object"
-    if "properties" not in schema:
-        schema["properties"] = {}
-
-    if not keep_descriptions:
-        for prop in schema.get("properties", {}).values():
-            if isinstance(prop, dict):
-                prop.pop("description", None)
-
-    return schema
+    minimized = dict(schema)
+    minimized.setdefault("type", "object")
+    properties = minimized.setdefault("properties", {})
+
+    if not keep_descriptions and properties:
+        minimized["properties"] = {
+            name: (
+                {k: v for k, v in prop.items() if k != "description"}
+                if isinstance(prop, dict) else prop
+            )
+            for name, prop in properties.items()
+        }
+
+    return minimized
@@ -12,22 +12,40 @@ Flow:
 
 from __future__ import annotations
 
-import json
+import asyncio
+import re
 import subprocess
 import sys
+from collections.abc import Awaitable
 from pathlib import Path
 
+import orjson
+
 ENV_PATH = Path(__file__).parent.parent / ".env"
 KEYCHAIN_SERVICE = "Claude Code-credentials"
 
-
-def _run(cmd: list[str], **kwargs) -> subprocess.CompletedProcess:
-    return subprocess.run(cmd, capture_output=True, text=True, **kwargs)
+_ACCESS_LINE_RE = re.compile(rb"^ANTHROPIC_AUTH_TOKEN=.*$", re.MULTILINE)
+_REFRESH_LINE_RE = re.compile(rb"^ANTHROPIC_REFRESH_TOKEN=.*$", re.MULTILINE)
+_REFRESH_LINE_REMOVE_RE = re.compile(rb"^ANTHROPIC_REFRESH_TOKEN=.*(?:\n|$)", re.MULTILINE)
 
 
-def check_claude_cli() -> bool:
+async def _run(cmd: list[str]) -> subprocess.CompletedProcess:
+    """Запустить команду асинхронно; отсутствующая программа — код 127."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        return subprocess.CompletedProcess(cmd, 127, "", "")
+    stdout, stderr = await proc.communicate()
+    return subprocess.CompletedProcess(
+        cmd, proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace"),
+    )
+
+
+async def check_claude_cli() -> bool:
     """Проверить наличие claude CLI."""
-    result = _run(["which", "claude"])
+    result = await _run(["which", "claude"])
     if result.returncode != 0:
         print("✗ Claude CLI не найден. Установите: npm install -g @anthropic-ai/claude-code")
         return False
@@ -35,16 +53,16 @@ def check_claude_cli() -> bool:
     return True
 
 
-def check_auth_status() -> dict | None:
+async def check_auth_status() -> dict | None:
     """Проверить статус авторизации Claude CLI."""
-    result = _run(["claude", "auth", "status"])
+    result = await _run(["claude", "auth", "status"])
     if result.returncode != 0:
         print("✗ Не удалось проверить статус авторизации")
         return None
 
     try:
-        status = json.loads(result.stdout)
-    except json.JSONDecodeError:
+        status = orjson.loads(result.stdout)
+    except orjson.JSONDecodeError:
         print(f"✗ Неожиданный ответ: {result.stdout}")
         return None
 
@@ -56,21 +74,31 @@ def check_auth_status() -> dict | None:
     return status
 
 
-def extract_token() -> dict | None:
-    """Извлечь OAuth токен из macOS Keychain."""
-    result = _run([
+async def _read_keychain() -> subprocess.CompletedProcess:
+    """Прочитать credentials Claude из macOS Keychain (без вывода)."""
+    return await _run([
         "security", "find-generic-password",
         "-s", KEYCHAIN_SERVICE, "-w",
     ])
+
+
+async def extract_token(
+    keychain: Awaitable[subprocess.CompletedProcess] | None = None,
+) -> dict | None:
+    """Извлечь OAuth токен из macOS Keychain.
+
+    keychain — уже запущенное чтение (_read_keychain), если его начали заранее.
+    """
+    result = await (keychain if keychain is not None else _read_keychain())
     if result.returncode != 0:
         print("✗ Токен не найден в Keychain")
         print("  Убедитесь что вы авторизованы: claude auth login")
         return None
 
     try:
-        creds = json.loads(result.stdout.strip())
+        creds = orjson.loads(result.stdout.strip())
         oauth = creds.get("claudeAiOauth", {})
-    except (json.JSONDecodeError, AttributeError):
+    except (orjson.JSONDecodeError, AttributeError):
         print("✗ Не удалось разобрать credentials из Keychain")
         return None
 
@@ -95,49 +123,57 @@ def extract_token() -> dict | None:
 
 
 def save_to_env(access_token: str, refresh_token: str = "") -> None:
-    """Сохранить access и refresh токены в .env файл."""
-    lines: list[str] = []
-    access_saved = False
-    refresh_saved = False
-
-    if ENV_PATH.exists():
-        for line in ENV_PATH.read_text().splitlines():
-            if line.startswith("ANTHROPIC_AUTH_TOKEN="):
-                lines.append(f"ANTHROPIC_AUTH_TOKEN={access_token}")
-                access_saved = True
-            elif line.startswith("ANTHROPIC_REFRESH_TOKEN="):
-                if refresh_token:
-                    lines.append(f"ANTHROPIC_REFRESH_TOKEN={refresh_token}")
-                    refresh_saved = True
-                # Если refresh_token пуст — удаляем старую строку
-            else:
-                lines.append(line)
-
-    if not access_saved:
-        lines.append(f"ANTHROPIC_AUTH_TOKEN={access_token}")
-    if refresh_token and not refresh_saved:
-        lines.append(f"ANTHROPIC_REFRESH_TOKEN={refresh_token}")
-
-    ENV_PATH.write_text("\n".join(lines) + "\n")
+    """Сохранить access и refresh токены в .env файл.
+
+    Существующие строки заменяются на месте, отсутствующие дописываются
+    в конец; при пустом refresh_token старая строка удаляется.
+    """
+    data = ENV_PATH.read_bytes() if ENV_PATH.exists() else b""
+    appended: list[bytes] = []
+
+    access_line = f"ANTHROPIC_AUTH_TOKEN={access_token}".encode()
+    # Замена через lambda — токен не разбирается как шаблон (\1, \g<...>)
+    data, count = _ACCESS_LINE_RE.subn(lambda _: access_line, data)
+    if not count:
+        appended.append(access_line)
+
+    if refresh_token:
+        refresh_line = f"ANTHROPIC_REFRESH_TOKEN={refresh_token}".encode()
+        data, count = _REFRESH_LINE_RE.subn(lambda _: refresh_line, data)
+        if not count:
+            appended.append(refresh_line)
+    else:
+        data = _REFRESH_LINE_REMOVE_RE.sub(b"", data)
+
+    data = data.rstrip(b"\n")
+    if appended:
+        data = b"\n".join([data, *appended]) if data else b"\n".join(appended)
+    ENV_PATH.write_bytes(data + b"\n")
     print(f"✓ Access token сохранён в {ENV_PATH}")
     if refresh_token:
         print(f"✓ Refresh token сохранён в {ENV_PATH}")
 
 
-def main() -> None:
+async def main() -> None:
     print("=== Настройка OAuth авторизации Claude ===\n")
 
-    if not check_claude_cli():
-        sys.exit(1)
-
-    status = check_auth_status()
-    if not status:
-        print("\nЗапустите авторизацию:")
-        print("  claude auth login")
-        print("\nПосле авторизации запустите эту команду снова.")
-        sys.exit(1)
-
-    token_data = extract_token()
+    # Чтение Keychain (самое долгое) идёт параллельно с проверкой CLI,
+    # а сообщения выводятся по порядку шагов
+    keychain = asyncio.create_task(_read_keychain())
+    try:
+        if not await check_claude_cli():
+            sys.exit(1)
+
+        status = await check_auth_status()
+        if not status:
+            print("\nЗапустите авторизацию:")
+            print("  claude auth login")
+            print("\nПосле авторизации запустите эту команду снова.")
+            sys.exit(1)
+
+        token_data = await extract_token(keychain)
+    finally:
+        keychain.cancel()
     if not token_data:
         sys.exit(1)
 
@@ -153,4 +189,4 @@ def main() -> None:
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
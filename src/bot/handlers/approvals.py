@@ -2,17 +2,20 @@
 
 from __future__ import annotations
 
-import json
 import logging
+import re
+import uuid
 
 import anthropic
+import orjson
 from aiogram import Router
 from aiogram.types import CallbackQuery
 
 from src.agent.core import AgentCore, PendingApproval
 from src.db.database import Database
-from src.db.queries import get_pending_approval, resolve_approval
-from src.utils.formatting import bold, escape, format_agent_response
+from src.db.models import ApprovalRequest
+from src.db.queries import clear_approval_context, get_pending_approval, resolve_approval
+from src.utils.formatting import bold, escape, format_agent_response, truncate
 from src.utils.tokens import format_tokens
 
 logger = logging.getLogger(__name__)
@@ -22,14 +25,12 @@ router = Router(name="approvals")
 
 async def _safe_edit(callback: CallbackQuery, html_text: str) -> None:
     """Отправить результат в Telegram с fallback на plain text и send_message."""
-    from src.utils.formatting import truncate
     try:
         await callback.message.edit_text(truncate(html_text), parse_mode="HTML")
     except Exception:
         logger.warning("HTML edit_text не удался, fallback на plain text")
         try:
             # Убираем HTML-теги для plain text
-            import re
             plain = re.sub(r"<[^>]+>", "", html_text)
             await callback.message.edit_text(truncate(plain))
         except Exception:
@@ -63,7 +64,6 @@ async def on_approve(callback: CallbackQuery, db: Database = None,
         if not row:
             await callback.answer("Запрос не найден", show_alert=True)
             return
-        from src.db.models import ApprovalRequest
         approval_req = ApprovalRequest(
             id=row["id"], project_id=row["project_id"],
             tool_name=row["tool_name"], tool_input=row["tool_input"],
@@ -75,8 +75,12 @@ async def on_approve(callback: CallbackQuery, db: Database = None,
     await callback.answer("Выполняю...")
 
     # Восстанавливаем контекст и выполняем инструмент
-    messages_snapshot = json.loads(approval_req.conversation_context) if approval_req.conversation_context else []
-    tool_input = json.loads(approval_req.tool_input)
+    messages_snapshot = (
+        orjson.loads(approval_req.conversation_context)
+        if approval_req.conversation_context else []
+    )
+    await clear_approval_context(db, approval_id)
+    tool_input = orjson.loads(approval_req.tool_input)
 
     # Извлекаем tool_use_id из messages_snapshot (последнее assistant-сообщение)
     tool_use_id = ""
@@ -90,7 +94,6 @@ async def on_approve(callback: CallbackQuery, db: Database = None,
                 break
     if not tool_use_id:
         # Fallback: генерируем валидный ID
-        import uuid
         tool_use_id = f"toolu_{uuid.uuid4().hex[:24]}"
 
     pending = PendingApproval(
@@ -100,11 +103,16 @@ async def on_approve(callback: CallbackQuery, db: Database = None,
         messages_snapshot=messages_snapshot,
     )
 
+    async def _preview(text: str) -> None:
+        """Живое превью ответа агента по мере стриминга."""
+        await callback.message.edit_text(truncate(text))
+
     # Фаза 1: выполняем инструмент и получаем ответ агента
     try:
         result = await agent.execute_approved_tool(
             project_id=approval_req.project_id,
             approval=pending,
+            on_text=_preview,
         )
     except anthropic.RateLimitError:
         logger.warning("429 Rate Limit при выполнении подтверждённого действия #%d", approval_id)
@@ -157,6 +165,7 @@ async def on_reject(callback: CallbackQuery, db: Database = None, **kwargs) -> N
         "SELECT * FROM approval_requests WHERE id = ?", (approval_id,),
     )
     tool_name = row["tool_name"] if row else "инструмент"
+    await clear_approval_context(db, approval_id)
     await callback.answer("Отклонено")
     await callback.message.edit_text(
         f"Действие {bold(tool_name)} отклонено.",
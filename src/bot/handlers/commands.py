@@ -355,6 +355,8 @@ async def _build_costs_text(db: Database) -> str:
     total_input = sum(r.tokens_input for r in records)
     total_output = sum(r.tokens_output for r in records)
     total_requests = sum(r.requests_count for r in records)
+    total_cache_read = sum(r.tokens_cache_read for r in records)
+    total_cache_write = sum(r.tokens_cache_write for r in records)
 
     lines = [f"{bold('Расходы за 7 дней')}\n"]
     for r in records:
@@ -365,6 +367,11 @@ async def _build_costs_text(db: Database) -> str:
     lines.append(f"\n{bold('Итого:')}")
     lines.append(f"  Запросов: {total_requests}")
     lines.append(f"  Токенов: {format_tokens(total_input)} in / {format_tokens(total_output)} out")
+    if total_cache_read or total_cache_write:
+        lines.append(
+            f"  Кеш: {format_tokens(total_cache_read)} read / "
+            f"{format_tokens(total_cache_write)} write"
+        )
     lines.append(f"  Стоимость: {bold(format_cost(total_cost))}")
 
     return "\n".join(lines)
@@ -3,10 +3,10 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import logging
 
 import anthropic
+import orjson
 from aiogram import Router
 from aiogram.types import Message
 
@@ -24,6 +24,8 @@ router = Router(name="queries")
 
 # Таймаут typing-индикатора в Telegram ~5 сек, обновляем каждые 4
 _TYPING_INTERVAL = 4.0
+# Лимит длины превью в статусном сообщении (лимит Telegram — 4096)
+_PREVIEW_LIMIT = 4000
 
 
 async def _keep_typing(chat_id: int, bot, stop: asyncio.Event) -> None:
@@ -66,11 +68,18 @@ async def handle_query(
         _keep_typing(message.chat.id, message.bot, stop_typing)
     )
 
+    async def _preview(text: str) -> None:
+        """Живое превью ответа: правим статусное сообщение по мере стриминга."""
+        if len(text) > _PREVIEW_LIMIT:
+            text = text[:_PREVIEW_LIMIT] + "…"
+        await status_msg.edit_text(text)
+
     try:
         logger.info("[handler] Запуск agent.run для проекта '%s'", project_id)
         result = await agent.run(
             project_id=project_id,
             user_message=message.text,
+            on_text=_preview,
         )
         logger.info("[handler] agent.run завершён, text=%d chars", len(result.text or ""))
     except anthropic.AuthenticationError:
@@ -123,9 +132,9 @@ async def handle_query(
             project_id=project_id,
             tool_name=approval.tool_name,
             tool_input=approval.tool_input,
-            conversation_context=json.dumps(
-                approval.messages_snapshot, ensure_ascii=False, default=str
-            ),
+            conversation_context=orjson.dumps(
+                approval.messages_snapshot, default=str,
+            ).decode(),
         )
 
         text_parts = []
@@ -137,7 +146,7 @@ async def handle_query(
         text_parts.append(f"Инструмент: {bold(approval.tool_name)}")
 
         # Показываем параметры (с обрезкой)
-        input_str = json.dumps(approval.tool_input, ensure_ascii=False, indent=2)
+        input_str = orjson.dumps(approval.tool_input, option=orjson.OPT_INDENT_2).decode()
         if len(input_str) > 500:
             input_str = input_str[:500] + "..."
         text_parts.append(f"\nПараметры:\n<pre>{escape(input_str)}</pre>")
@@ -0,0 +1,3 @@
+-- Учёт prompt cache: сколько токенов прочитано из кеша и записано в кеш
+ALTER TABLE cost_tracking ADD COLUMN tokens_cache_read INTEGER DEFAULT 0;
+ALTER TABLE cost_tracking ADD COLUMN tokens_cache_write INTEGER DEFAULT 0;
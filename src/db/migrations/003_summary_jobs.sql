@@ -0,0 +1,12 @@
+-- Очередь фонового сжатия истории через Message Batches API
+CREATE TABLE IF NOT EXISTS summary_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project_id TEXT NOT NULL,
+    history_text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',  -- queued | submitted
+    batch_id TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_summary_jobs_status
+    ON summary_jobs(status, project_id);
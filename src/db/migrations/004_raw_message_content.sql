@@ -0,0 +1,4 @@
+-- Сообщения хранятся как есть, без JSON-кодирования строки:
+-- разворачиваем ранее сохранённые JSON-строки ("...") в обычный текст
+UPDATE conversations SET content = json_extract(content, '$')
+    WHERE json_valid(content) AND json_type(content) = 'text';
@@ -0,0 +1,3 @@
+-- id последнего сжимаемого сообщения: резюме из batch сохраняется с ним
+-- и переиспользуется так же, как резюме синхронного сжатия
+ALTER TABLE summary_jobs ADD COLUMN messages_end_id INTEGER NOT NULL DEFAULT 0;
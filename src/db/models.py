@@ -40,6 +40,8 @@ class CostRecord:
     requests_count: int = 0
     tokens_input: int = 0
     tokens_output: int = 0
+    tokens_cache_read: int = 0
+    tokens_cache_write: int = 0
     cost_usd: float = 0.0
 
 
@@ -2,11 +2,12 @@
 
 from __future__ import annotations
 
-import json
 from datetime import date, datetime, timezone
 
+import orjson
+
 from src.db.database import Database
-from src.db.models import ApprovalRequest, Conversation, CostRecord, ToolCall
+from src.db.models import ApprovalRequest, CostRecord, ToolCall
 
 # --- Conversations ---
 
@@ -23,54 +24,88 @@ async def save_message(db: Database, project_id: str, role: str, content: str,
     return cursor.lastrowid
 
 
-async def get_conversation_history(db: Database, project_id: str,
-                                   limit: int = 50) -> list[Conversation]:
-    """Получить последние N сообщений проекта."""
+async def save_messages_batch(
+    db: Database, project_id: str,
+    rows: list[tuple[str, str, int, int]],
+) -> None:
+    """Сохранить несколько сообщений одной транзакцией.
+
+    rows — список (role, content, tokens_input, tokens_output) в порядке диалога.
+    """
+    await db.executemany(
+        "INSERT INTO conversations (project_id, role, content, tokens_input, tokens_output) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [(project_id, role, content, tin, tout) for role, content, tin, tout in rows],
+    )
+    await db.commit()
+
+
+async def get_conversation_turns(db: Database, project_id: str,
+                                 limit: int = 50) -> list[tuple[str, str]]:
+    """Получить последние N сообщений проекта как (role, content).
+
+    Читает только две колонки, которые нужны для сборки messages.
+    """
     rows = await db.fetchall(
-        "SELECT * FROM conversations WHERE project_id = ? "
+        "SELECT role, content FROM conversations WHERE project_id = ? "
         "ORDER BY id DESC LIMIT ?",
         (project_id, limit),
     )
-    return [
-        Conversation(
-            id=r["id"], project_id=r["project_id"], role=r["role"],
-            content=r["content"], tokens_input=r["tokens_input"],
-            tokens_output=r["tokens_output"], created_at=r["created_at"],
-        )
-        for r in reversed(rows)
-    ]
+    return [(r[0], r[1]) for r in reversed(rows)]
 
 
 async def clear_conversation(db: Database, project_id: str) -> None:
-    """Очистить историю разговора проекта."""
+    """Очистить историю разговора проекта (вместе с её резюме)."""
     await db.execute("DELETE FROM conversations WHERE project_id = ?", (project_id,))
+    await db.execute("DELETE FROM conversation_summaries WHERE project_id = ?", (project_id,))
     await db.commit()
 
 
 # --- Tool Calls ---
 
 
+_INSERT_TOOL_CALL_SQL = (
+    "INSERT INTO tool_calls "
+    "(project_id, tool_name, tool_input, tool_result, model, "
+    "tokens_input, tokens_output, latency_ms, is_error) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def tool_call_row(project_id: str, tool_name: str,
+                  tool_input: dict | None, tool_result: str | None,
+                  model: str, tokens_input: int = 0, tokens_output: int = 0,
+                  latency_ms: int = 0, is_error: bool = False) -> tuple:
+    """Параметры строки tool_calls (для log_tool_call / log_tool_calls)."""
+    input_json = orjson.dumps(tool_input).decode() if tool_input else None
+    # Обрезаем результат до 10KB для экономии места
+    if tool_result and len(tool_result) > 10240:
+        tool_result = tool_result[:10240] + "...[обрезано]"
+    return (project_id, tool_name, input_json, tool_result, model,
+            tokens_input, tokens_output, latency_ms, is_error)
+
+
 async def log_tool_call(db: Database, project_id: str, tool_name: str,
                         tool_input: dict | None, tool_result: str | None,
                         model: str, tokens_input: int = 0, tokens_output: int = 0,
                         latency_ms: int = 0, is_error: bool = False) -> int:
     """Записать вызов инструмента в лог."""
-    input_json = json.dumps(tool_input, ensure_ascii=False) if tool_input else None
-    # Обрезаем результат до 10KB для экономии места
-    if tool_result and len(tool_result) > 10240:
-        tool_result = tool_result[:10240] + "...[обрезано]"
-    cursor = await db.execute(
-        "INSERT INTO tool_calls "
-        "(project_id, tool_name, tool_input, tool_result, model, "
-        "tokens_input, tokens_output, latency_ms, is_error) "
-        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-        (project_id, tool_name, input_json, tool_result, model,
-         tokens_input, tokens_output, latency_ms, is_error),
-    )
+    cursor = await db.execute(_INSERT_TOOL_CALL_SQL, tool_call_row(
+        project_id, tool_name, tool_input, tool_result, model,
+        tokens_input, tokens_output, latency_ms, is_error,
+    ))
     await db.commit()
     return cursor.lastrowid
 
 
+async def log_tool_calls(db: Database, rows: list[tuple]) -> None:
+    """Записать несколько вызовов (строки из tool_call_row) одним commit."""
+    if not rows:
+        return
+    await db.executemany(_INSERT_TOOL_CALL_SQL, rows)
+    await db.commit()
+
+
 # --- Cost Tracking ---
 
 # Стоимость за 1M токенов (input/output)
@@ -82,21 +117,30 @@ MODEL_PRICING = {
 
 
 async def track_cost(db: Database, project_id: str, model: str,
-                     tokens_input: int, tokens_output: int) -> None:
-    """Обновить агрегированные расходы за день."""
+                     tokens_input: int, tokens_output: int,
+                     cache_read: int = 0, cache_write: int = 0) -> None:
+    """Обновить агрегированные расходы за день.
+
+    cache_read / cache_write — токены prompt cache (в cost_usd не входят,
+    учитываются для оценки hit rate).
+    """
     today = datetime.now(timezone.utc).date().isoformat()
     input_price, output_price = MODEL_PRICING.get(model, (3.00, 15.00))
     cost = (tokens_input * input_price + tokens_output * output_price) / 1_000_000
 
     await db.execute(
         "INSERT INTO cost_tracking (date, project_id, model, requests_count, "
-        "tokens_input, tokens_output, cost_usd) VALUES (?, ?, ?, 1, ?, ?, ?) "
+        "tokens_input, tokens_output, tokens_cache_read, tokens_cache_write, cost_usd) "
+        "VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?) "
         "ON CONFLICT(date, project_id, model) DO UPDATE SET "
         "requests_count = requests_count + 1, "
         "tokens_input = tokens_input + excluded.tokens_input, "
         "tokens_output = tokens_output + excluded.tokens_output, "
+        "tokens_cache_read = tokens_cache_read + excluded.tokens_cache_read, "
+        "tokens_cache_write = tokens_cache_write + excluded.tokens_cache_write, "
         "cost_usd = cost_usd + excluded.cost_usd",
-        (today, project_id, model, tokens_input, tokens_output, cost),
+        (today, project_id, model, tokens_input, tokens_output,
+         cache_read, cache_write, cost),
     )
     await db.commit()
 
@@ -105,7 +149,8 @@ async def get_costs_summary(db: Database, days: int = 7) -> list[CostRecord]:
     """Получить сводку расходов за последние N дней."""
     rows = await db.fetchall(
         "SELECT date, project_id, model, requests_count, "
-        "tokens_input, tokens_output, cost_usd FROM cost_tracking "
+        "tokens_input, tokens_output, tokens_cache_read, tokens_cache_write, "
+        "cost_usd FROM cost_tracking "
         "WHERE date >= date('now', ?) ORDER BY date DESC",
         (f"-{days} days",),
     )
@@ -113,7 +158,8 @@ async def get_costs_summary(db: Database, days: int = 7) -> list[CostRecord]:
         CostRecord(
             date=r["date"], project_id=r["project_id"], model=r["model"],
             requests_count=r["requests_count"], tokens_input=r["tokens_input"],
-            tokens_output=r["tokens_output"], cost_usd=r["cost_usd"],
+            tokens_output=r["tokens_output"], tokens_cache_read=r["tokens_cache_read"],
+            tokens_cache_write=r["tokens_cache_write"], cost_usd=r["cost_usd"],
         )
         for r in rows
     ]
@@ -130,7 +176,7 @@ async def create_approval(db: Database, project_id: str, tool_name: str,
         "INSERT INTO approval_requests "
         "(project_id, tool_name, tool_input, conversation_context, telegram_message_id) "
         "VALUES (?, ?, ?, ?, ?)",
-        (project_id, tool_name, json.dumps(tool_input, ensure_ascii=False),
+        (project_id, tool_name, orjson.dumps(tool_input).decode(),
          conversation_context, telegram_message_id),
     )
     await db.commit()
@@ -152,6 +198,30 @@ async def resolve_approval(db: Database, approval_id: int, status: str) -> bool:
     return cursor.rowcount > 0
 
 
+async def clear_approval_context(db: Database, approval_id: int) -> None:
+    """Удалить snapshot разговора у обработанного запроса (он больше не нужен)."""
+    await db.execute(
+        "UPDATE approval_requests SET conversation_context = NULL WHERE id = ?",
+        (approval_id,),
+    )
+    await db.commit()
+
+
+async def expire_approval_contexts(db: Database, max_age_seconds: int) -> int:
+    """Удалить snapshot разговора у запросов старше max_age_seconds.
+
+    Нужно для запросов, по которым так и не нажали ни одну кнопку.
+    Возвращает число очищенных строк.
+    """
+    cursor = await db.execute(
+        "UPDATE approval_requests SET conversation_context = NULL "
+        "WHERE conversation_context IS NOT NULL AND created_at < datetime('now', ?)",
+        (f"-{max_age_seconds} seconds",),
+    )
+    await db.commit()
+    return cursor.rowcount
+
+
 async def get_pending_approval(db: Database, approval_id: int) -> ApprovalRequest | None:
     """Получить ожидающий подтверждения запрос."""
     row = await db.fetchone(
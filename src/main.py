@@ -64,6 +64,7 @@ async def main() -> None:
 
     # --- Агент ---
     agent = AgentCore(settings, db, mcp_manager)
+    agent.start()
 
     # --- Telegram Bot ---
     bot = Bot(
@@ -112,6 +113,7 @@ async def main() -> None:
         _shutdown_done = True
         logger.info("Остановка...")
         await scheduler.stop()
+        await agent.close()
         await mcp_manager.stop_all()
         await db.close()
         await bot.session.close()
@@ -90,8 +90,12 @@ class MCPClient:
         return self._tools
 
     async def call_tool(self, tool_name: str, arguments: dict[str, Any],
-                        timeout: float = 60.0) -> str:
-        """Вызвать инструмент MCP-сервера с таймаутом."""
+                        timeout: float = 60.0, max_chars: int | None = None) -> str:
+        """Вызвать инструмент MCP-сервера с таймаутом.
+
+        max_chars — не собирать текст результата длиннее этого лимита
+        (лишние блоки отбрасываются, не склеиваясь в одну большую строку).
+        """
         if not self._session:
             raise RuntimeError(f"MCP '{self.name}' не подключён")
 
@@ -112,10 +116,15 @@ class MCPClient:
         # Извлекаем текст из результата
         if result.content:
             parts = []
+            total = 0
             for block in result.content:
                 if hasattr(block, "text"):
                     parts.append(block.text)
                 else:
                     parts.append(str(block))
-            return "\n".join(parts)
+                total += len(parts[-1]) + 1
+                if max_chars and total >= max_chars:
+                    break
+            text = "\n".join(parts)
+            return text[:max_chars] if max_chars else text
         return ""
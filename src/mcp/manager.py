@@ -29,6 +29,9 @@ class MCPManager:
         self._instance_refcount: dict[str, set[str]] = {}  # instance_id → {project_ids}
         self._orphaned_stacks: list[AsyncExitStack] = []
         self._lock = asyncio.Lock()  # Защита от concurrent start/stop
+        # Счётчик изменений набора инстансов/инструментов — ключ инвалидации
+        # кешей, построенных поверх реестра (см. AgentCore._get_anthropic_tools)
+        self.instances_version = 0
 
     async def start_all(self) -> None:
         """Запустить MCP-серверы для всех проектов.
@@ -99,6 +102,7 @@ class MCPManager:
                         client = self.instances.pop(instance_id, None)
                         if client:
                             self.registry.unregister_instance(instance_id)
+                            self.instances_version += 1
                             client._session = None
                             client._tools = []
                             if client._exit_stack:
@@ -129,6 +133,7 @@ class MCPManager:
         self.instances.clear()
         self.registry.clear()
         self._instance_refcount.clear()
+        self.instances_version += 1
         logger.info("Все MCP-серверы остановлены")
 
     async def _start_instance(
@@ -143,6 +148,7 @@ class MCPManager:
             prefix = TOOL_PREFIX_MAP.get(config.type, "")
             self.registry.register_instance(instance_id, client, prefix=prefix)
             self.instances[instance_id] = client
+            self.instances_version += 1
 
             logger.info(
                 "Instance '%s' (%s) запущен, инструментов: %d",
@@ -175,6 +181,7 @@ class MCPManager:
     async def call_tool(
         self, tool_name: str, arguments: dict[str, Any],
         project_id: str | None = None,
+        max_chars: int | None = None,
     ) -> str:
         """Вызвать инструмент через соответствующий MCP-клиент.
 
@@ -184,6 +191,8 @@ class MCPManager:
 
         project_id — для корректной маршрутизации при одинаковых tool names
         (например, два Gmail-инстанса для разных проектов).
+
+        max_chars — ограничение длины результата при чтении (см. MCPClient.call_tool).
         """
         # Приоритетный lookup по инстансам проекта
         client = None
@@ -208,7 +217,8 @@ class MCPManager:
                 self.registry.register_instance(client.name, client, prefix=prefix)
             else:
                 self.registry.register_client(client)
+            self.instances_version += 1
 
         # Преобразуем prefixed name → original name для вызова
         original_name = self.registry.get_original_tool_name(tool_name)
-        return await client.call_tool(original_name, arguments)
+        return await client.call_tool(original_name, arguments, max_chars=max_chars)
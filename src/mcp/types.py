@@ -217,3 +217,12 @@ MCP_TYPE_META: dict[McpServerType, McpTypeMeta] = {
         ],
     ),
 }
+
+
+# Префиксы read-only инструментов всех типов с учётом namespace prefix —
+# такие вызовы безопасно выполнять параллельно
+READ_TOOL_PREFIXES: tuple[str, ...] = tuple(
+    TOOL_PREFIX_MAP.get(stype, "") + prefix
+    for stype, meta in MCP_TYPE_META.items()
+    for prefix in meta.tool_prefixes_read
+)
@@ -101,6 +101,30 @@ class GlobalConfig(BaseModel):
     phase: str = "read_only"
     db_path: str = "data/agent.db"
     auth_method: str = "api_key"
+    # Локальная классификация по ключевым словам до вызова Haiku
+    local_classifier: bool = True
+    # Параллельное выполнение нескольких tool_use из одного ответа Claude:
+    # параллелится батч, только если все инструменты в нём из allow-list
+    # (имена или префиксы), иначе вызовы идут последовательно.
+    # safe_parallel_tools пуст — allow-list = read-only инструменты
+    # из MCP_TYPE_META (READ_TOOL_PREFIXES), записи не параллелятся.
+    parallel_tools: bool = True
+    safe_parallel_tools: list[str] = Field(default_factory=list)
+    # Лимит обрезки результата инструмента (символов) для инструментов
+    # без собственного лимита в TOOL_RESULT_LIMITS
+    tool_result_max_chars: int = 2000
+    # TTL prompt cache: длинный — для стабильных system prompt и tools,
+    # короткий — для breakpoints на истории диалога ("5m" или "1h")
+    cache_ttl_long: str = "1h"
+    cache_ttl_short: str = "5m"
+    # Keep-warm: фоновый минимальный запрос до истечения TTL, чтобы
+    # следующий реальный ход читал tools из кеша, а не писал заново.
+    # Останавливается, если проект неактивен дольше cache_keepalive_idle_minutes.
+    cache_keepalive: bool = False
+    cache_keepalive_idle_minutes: int = 120
+    # Сжатие истории через Message Batches API (в фоне, на 50% дешевле):
+    # ход не ждёт Haiku, резюме подхватывается на следующих ходах
+    batch_summarization: bool = False
     # Именованные MCP-инстансы (instance_id → config)
     mcp_instances: dict[str, McpInstanceConfig] = Field(default_factory=dict)
 
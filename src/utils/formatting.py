@@ -3,6 +3,12 @@
 from __future__ import annotations
 
 import html
+import re
+
+# Markdown → Telegram HTML (см. format_agent_response)
+_BOLD_RE = re.compile(r"\*\*(.+?)\*\*")
+_ITALIC_RE = re.compile(r"(?<!\*)\*(?!\*)(.+?)(?<!\*)\*(?!\*)")
+_CODE_RE = re.compile(r"`([^`]+)`")
 
 
 def escape(text: str) -> str:
@@ -45,17 +51,15 @@ def format_agent_response(text: str) -> str:
     Базовое преобразование наиболее частых паттернов.
     Сначала экранируем HTML-сущности, потом конвертируем markdown.
     """
-    import re
-
     # 1. Экранируем HTML-сущности ДО конвертации markdown
     #    Иначе <email@example.com> ломает Telegram HTML parser
     result = html.escape(text)
 
     # 2. Конвертируем markdown → HTML
     # **bold** -> <b>bold</b>
-    result = re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", result)
+    result = _BOLD_RE.sub(r"<b>\1</b>", result)
     # *italic* -> <i>italic</i>
-    result = re.sub(r"(?<!\*)\*(?!\*)(.+?)(?<!\*)\*(?!\*)", r"<i>\1</i>", result)
+    result = _ITALIC_RE.sub(r"<i>\1</i>", result)
     # `code` -> <code>code</code>
-    result = re.sub(r"`([^`]+)`", r"<code>\1</code>", result)
+    result = _CODE_RE.sub(r"<code>\1</code>", result)
     return truncate(result)
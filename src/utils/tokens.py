@@ -2,6 +2,9 @@
 
 from __future__ import annotations
 
+# Консервативная оценка: ~2.5 символа на токен (русский + JSON)
+CHARS_PER_TOKEN = 2.5
+
 
 def estimate_tokens(text: str) -> int:
     """Грубая оценка количества токенов по символам.
@@ -11,8 +14,14 @@ def estimate_tokens(text: str) -> int:
     """
     if not text:
         return 0
-    # Консервативная оценка: ~2.5 символа на токен (русский + JSON)
-    return max(1, int(len(text) / 2.5))
+    return estimate_tokens_from_chars(len(text))
+
+
+def estimate_tokens_from_chars(chars: int) -> int:
+    """Оценка токенов по уже посчитанной длине текста (без склейки строк)."""
+    if chars <= 0:
+        return 0
+    return max(1, int(chars / CHARS_PER_TOKEN))
 
 
 def format_cost(cost_usd: float) -> str:
@@ -0,0 +1,41 @@
+"""Тесты записи токенов в .env."""
+
+import pytest
+
+from src import auth_setup
+
+
+@pytest.fixture
+def env_path(tmp_path, monkeypatch):
+    path = tmp_path / ".env"
+    monkeypatch.setattr(auth_setup, "ENV_PATH", path)
+    return path
+
+
+def test_creates_file(env_path):
+    auth_setup.save_to_env("acc", "ref")
+    assert env_path.read_text() == "ANTHROPIC_AUTH_TOKEN=acc\nANTHROPIC_REFRESH_TOKEN=ref\n"
+
+
+def test_replaces_lines_in_place(env_path):
+    env_path.write_text(
+        "TELEGRAM_BOT_TOKEN=t\nANTHROPIC_AUTH_TOKEN=old\nANTHROPIC_REFRESH_TOKEN=old\nDEBUG=1\n"
+    )
+    auth_setup.save_to_env("new", "new-ref")
+    assert env_path.read_text() == (
+        "TELEGRAM_BOT_TOKEN=t\nANTHROPIC_AUTH_TOKEN=new\nANTHROPIC_REFRESH_TOKEN=new-ref\nDEBUG=1\n"
+    )
+
+
+def test_appends_missing_lines(env_path):
+    env_path.write_text("TELEGRAM_BOT_TOKEN=t\n")
+    auth_setup.save_to_env("acc", "ref")
+    assert env_path.read_text() == (
+        "TELEGRAM_BOT_TOKEN=t\nANTHROPIC_AUTH_TOKEN=acc\nANTHROPIC_REFRESH_TOKEN=ref\n"
+    )
+
+
+def test_without_refresh_removes_stale_line(env_path):
+    env_path.write_text("ANTHROPIC_AUTH_TOKEN=old\nANTHROPIC_REFRESH_TOKEN=old\nDEBUG=1\n")
+    auth_setup.save_to_env("acc")
+    assert env_path.read_text() == "ANTHROPIC_AUTH_TOKEN=acc\nDEBUG=1\n"
@@ -0,0 +1,48 @@
+"""Тесты классификатора: быстрый путь и разбор ответа Haiku."""
+
+import orjson
+import pytest
+
+from src.agent.classifier import _parse_json_answer, quick_classify
+
+
+@pytest.mark.parametrize("text", ["привет", "Спасибо!", "ок", "Доброе утро", "👍👍"])
+def test_quick_classify_small_talk(text):
+    result = quick_classify(text)
+    assert result is not None
+    assert result.is_simple and not result.needs_tools and result.categories == []
+
+
+@pytest.mark.parametrize(
+    "text", ["а за вчера?", "покажи письма", "", "привет, найди письмо от Ивана"],
+)
+def test_quick_classify_defers_to_model(text):
+    assert quick_classify(text) is None
+
+
+def test_parse_plain_json():
+    assert _parse_json_answer('{"needs_tools": true}') == {"needs_tools": True}
+
+
+def test_parse_fenced_json():
+    text = '```json\n{"categories": ["gmail"]}\n```'
+    assert _parse_json_answer(text) == {"categories": ["gmail"]}
+
+
+def test_parse_first_of_several_objects():
+    text = 'Ответ: {"a": 1} и ещё {"b": 2}'
+    assert _parse_json_answer(text) == {"a": 1}
+
+
+def test_parse_skips_invalid_brace_before_object():
+    assert _parse_json_answer('set {x} then {"a": {"b": 1}} end') == {"a": {"b": 1}}
+
+
+def test_parse_without_object_raises():
+    with pytest.raises(orjson.JSONDecodeError):
+        _parse_json_answer("нет json")
+
+
+def test_parse_non_object_raises():
+    with pytest.raises(TypeError):
+        _parse_json_answer("[1, 2]")
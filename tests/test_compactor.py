@@ -0,0 +1,45 @@
+"""Тесты дословного сжатия результатов инструментов."""
+
+from src.agent.compactor import compact_tool_result
+
+NON_EMAIL = "Иван пишет:\nПривет\n--\nid: 123\nthread: abc\n> цитата из Slack\n"
+
+
+def test_non_email_keeps_quotes_separators_and_ids():
+    assert compact_tool_result(NON_EMAIL) == NON_EMAIL.strip()
+
+
+def test_email_keeps_header_without_quote_block_and_bare_dashes():
+    result = compact_tool_result("Иван пишет:\nПривет\n--\nid: 123\nthread: abc", email=True)
+    assert result == "Иван пишет:\nПривет\n--\nid: 123\nthread: abc"
+
+
+def test_email_removes_quote_header_with_quoted_lines():
+    text = "Ответ выше\n\nOn Mon, 1 Jan 2024 Bob wrote:\n> старое письмо\n> ещё строка\n"
+    assert compact_tool_result(text, email=True) == "Ответ выше"
+
+
+def test_email_removes_rfc_signature_only():
+    text = "Текст письма\n-- \nИван Иванов\nCEO\n\nID: 42"
+    assert compact_tool_result(text, email=True) == "Текст письма\n\nID: 42"
+
+
+def test_signature_is_limited_in_length():
+    body = "\n".join(f"line {i}" for i in range(10))
+    result = compact_tool_result(f"-- \n{body}", email=True)
+    assert result.startswith("line 6")
+
+
+def test_base64_elided_and_html_noise_removed():
+    blob = "A" * 300
+    text = f"<style>p{{}}</style>data {blob} end<!-- c -->"
+    assert compact_tool_result(text) == "data <elided 300 bytes> end"
+
+
+def test_repeated_lines_collapsed_and_blank_lines_squeezed():
+    text = "err\nerr\nerr\n\n\n\nok   "
+    assert compact_tool_result(text) == "err  [×3]\n\nok"
+
+
+def test_empty_text():
+    assert compact_tool_result("") == ""
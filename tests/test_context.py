@@ -0,0 +1,144 @@
+"""Тесты обрезки истории: ходы целиком, резюме, гистерезис."""
+
+import logging
+from itertools import pairwise
+
+from src.agent.context import (
+    SUMMARY_PREFIX,
+    TRIM_TARGET_RATIO,
+    TRIM_WEIGHT_CORRECTION,
+    TRIM_WEIGHT_TOOL_RESULT,
+    _split_turns,
+    _turn_weight,
+    estimate_messages_tokens,
+    trim_messages,
+)
+
+
+def _turn(n: int, size: int = 500) -> list[dict]:
+    return [
+        {"role": "user", "content": f"вопрос {n} " + "x" * size},
+        {"role": "assistant", "content": f"ответ {n} " + "y" * size},
+    ]
+
+
+def _tool_turn(n: int, result_size: int = 200) -> list[dict]:
+    tool_id = f"toolu_{n}"
+    return [
+        {"role": "user", "content": f"найди письма {n}"},
+        {"role": "assistant", "content": [
+            {"type": "tool_use", "id": tool_id, "name": "gmail_search", "input": {}},
+        ]},
+        {"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": tool_id, "content": "z" * result_size},
+        ]},
+        {"role": "assistant", "content": f"нашёл {n}"},
+    ]
+
+
+def _history(*turns: list[dict]) -> list[dict]:
+    return [msg for turn in turns for msg in turn]
+
+
+def _tool_ids(messages: list[dict], block_type: str, key: str) -> set[str]:
+    return {
+        block[key]
+        for msg in messages if isinstance(msg["content"], list)
+        for block in msg["content"] if block.get("type") == block_type
+    }
+
+
+def test_under_limit_returns_same_list():
+    messages = _history(*(_turn(i) for i in range(3)))
+    assert trim_messages(messages) is messages
+
+
+def test_over_limit_trims_to_target_ratio():
+    messages = _history(*(_turn(i) for i in range(20)))
+    assert estimate_messages_tokens(messages) > 4_000
+
+    trimmed = trim_messages(messages)
+
+    assert estimate_messages_tokens(trimmed) <= int(4_000 * TRIM_TARGET_RATIO)
+    # Гистерезис: повторный вызов на обрезанной истории ничего не меняет
+    assert trim_messages(trimmed) is trimmed
+
+
+def test_oversized_pinned_turn_returns_same_list(caplog):
+    messages = _history(_tool_turn(0, result_size=12_000))
+    assert estimate_messages_tokens(messages) > 4_000
+
+    with caplog.at_level(logging.WARNING, logger="src.agent.context"):
+        assert trim_messages(messages) is messages
+    assert not caplog.records
+
+
+def test_last_turn_always_kept():
+    messages = _history(*(_turn(i) for i in range(20)))
+    trimmed = trim_messages(messages)
+    assert trimmed[-2:] == messages[-2:]
+
+
+def test_summary_prefix_pinned():
+    summary = {"role": "user", "content": f"{SUMMARY_PREFIX}\nобсуждали релиз"}
+    reply = {"role": "assistant", "content": "Понял, продолжаем."}
+    messages = [summary, reply, *_history(*(_turn(i) for i in range(20)))]
+
+    trimmed = trim_messages(messages)
+
+    assert trimmed[:2] == [summary, reply]
+    assert len(trimmed) < len(messages)
+
+
+def test_roles_alternate_after_trim():
+    messages = _history(*(
+        _tool_turn(i) if i % 3 == 0 else _turn(i) for i in range(20)
+    ))
+    trimmed = trim_messages(messages)
+
+    assert trimmed[0]["role"] == "user"
+    for prev, cur in pairwise(trimmed):
+        assert prev["role"] != cur["role"]
+
+
+def test_tool_pairs_kept_together():
+    messages = _history(*(
+        _tool_turn(i) if i % 3 == 0 else _turn(i) for i in range(20)
+    ))
+    trimmed = trim_messages(messages)
+
+    used = _tool_ids(trimmed, "tool_use", "id")
+    assert used == _tool_ids(trimmed, "tool_result", "tool_use_id")
+    # Дешёвые ходы с инструментами ценнее обычных и переживают обрезку
+    assert used
+
+
+def test_oversized_tool_turn_removed_whole():
+    messages = _history(_tool_turn(0, result_size=8_000), *(_turn(i) for i in range(1, 6)))
+    trimmed = trim_messages(messages)
+
+    assert not _tool_ids(trimmed, "tool_use", "id")
+    assert not _tool_ids(trimmed, "tool_result", "tool_use_id")
+    assert not any(m["content"] == "найди письма 0" for m in trimmed)
+
+
+def test_split_turns_groups_tool_results_with_request():
+    messages = _history(_turn(0), _tool_turn(1), _turn(2))
+    assert _split_turns(messages) == [[0, 1], [2, 3, 4, 5], [6, 7]]
+
+
+def test_turn_weight():
+    messages = _history(
+        _turn(0),
+        _tool_turn(1),
+        [
+            {"role": "user", "content": "нет, неправильно"},
+            {"role": "assistant", "content": "исправил"},
+        ],
+    )
+    turns = _split_turns(messages)
+    old = 10
+    assert _turn_weight(messages, turns[0], old) == 1
+    assert _turn_weight(messages, turns[0], 0) > 1
+    assert _turn_weight(messages, turns[1], old) == TRIM_WEIGHT_TOOL_RESULT
+    assert _turn_weight(messages, turns[2], old) == TRIM_WEIGHT_CORRECTION
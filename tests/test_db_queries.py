@@ -0,0 +1,70 @@
+"""Тесты запросов к БД (временная SQLite)."""
+
+import asyncio
+
+from src.db.database import Database
+from src.db.queries import (
+    create_approval,
+    expire_approval_contexts,
+    log_tool_calls,
+    tool_call_row,
+)
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_log_tool_calls_writes_all_rows_in_one_commit(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "agent.db"))
+        await db.connect()
+        try:
+            rows = [
+                tool_call_row("p", "search_emails", {"query": "x"}, "ok", "m", latency_ms=5),
+                tool_call_row("p", "read_email", None, "Ошибка: boom", "m", is_error=True),
+            ]
+            await log_tool_calls(db, rows)
+            await log_tool_calls(db, [])
+            return await db.fetchall(
+                "SELECT tool_name, tool_input, is_error FROM tool_calls ORDER BY id",
+            )
+        finally:
+            await db.close()
+
+    result = _run(scenario())
+    assert [(r[0], r[1], r[2]) for r in result] == [
+        ("search_emails", '{"query":"x"}', 0),
+        ("read_email", None, 1),
+    ]
+
+
+def test_tool_call_row_truncates_long_result():
+    row = tool_call_row("p", "t", None, "x" * 20_000, "m")
+    assert row[3].endswith("...[обрезано]")
+    assert len(row[3]) == 10240 + len("...[обрезано]")
+
+
+def test_expire_approval_contexts_clears_only_stale_snapshots(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "agent.db"))
+        await db.connect()
+        try:
+            stale = await create_approval(db, "p", "send_email", {}, '[{"role":"user"}]')
+            fresh = await create_approval(db, "p", "send_email", {}, '[{"role":"user"}]')
+            await db.execute(
+                "UPDATE approval_requests SET created_at = datetime('now', '-2 hours') "
+                "WHERE id = ?", (stale,),
+            )
+            cleared = await expire_approval_contexts(db, 3600)
+            rows = await db.fetchall(
+                "SELECT id, conversation_context FROM approval_requests ORDER BY id",
+            )
+            return cleared, {r[0]: r[1] for r in rows}, stale, fresh
+        finally:
+            await db.close()
+
+    cleared, contexts, stale, fresh = _run(scenario())
+    assert cleared == 1
+    assert contexts[stale] is None
+    assert contexts[fresh] is not None
@@ -0,0 +1,53 @@
+"""Тесты локального классификатора по ключевым словам."""
+
+import pytest
+
+from src.agent.local_classifier import local_classify
+
+ALL = ["gmail", "calendar", "telegram", "whatsapp", "slack", "confluence", "jira"]
+
+
+@pytest.mark.parametrize(("text", "expected"), [
+    ("Покажи непрочитанные письма", ["gmail"]),
+    ("какие встречи завтра?", ["calendar"]),
+    ("что в Jira по релизу", ["jira"]),
+    ("проверь почту и календарь", ["gmail", "calendar"]),
+])
+def test_explicit_mentions(text, expected):
+    result = local_classify(text, ALL)
+    assert result is not None
+    assert result.needs_tools and not result.is_simple
+    assert result.categories == expected
+
+
+@pytest.mark.parametrize("text", ["что нового?", "напомни, о чём договорились", ""])
+def test_no_keywords_defers_to_model(text):
+    assert local_classify(text, ALL) is None
+
+
+def test_unavailable_service_defers_to_model():
+    assert local_classify("что в слаке и почте?", ["gmail"]) is None
+
+
+@pytest.mark.parametrize("text", [
+    "pgtg сломался",
+    "настрой mailchimp",
+    "разошли по mailing list",
+    "почти готово?",
+    "какие события на этой неделе",
+    "расписание релиза",
+    "найди в википедии",
+    "распакуй archive.tgz",
+])
+def test_weak_keywords_defer_to_model(text):
+    assert local_classify(text, ALL) is None
+
+
+@pytest.mark.parametrize(("text", "expected"), [
+    ("есть новые mail?", ["gmail"]),
+    ("что пишут в tg", ["telegram"]),
+    ("обнови wiki страницу", ["confluence"]),
+])
+def test_short_keywords_as_whole_words(text, expected):
+    result = local_classify(text, ALL)
+    assert result is not None and result.categories == expected
@@ -0,0 +1,18 @@
+"""Тесты метаданных MCP-типов."""
+
+from src.mcp.types import MCP_TYPE_META, READ_TOOL_PREFIXES, TOOL_PREFIX_MAP
+
+
+def test_read_prefixes_are_namespaced():
+    assert "tg_get_" in READ_TOOL_PREFIXES
+    assert "search_emails" in READ_TOOL_PREFIXES
+
+
+def test_no_write_tool_matches_read_prefixes():
+    write_tools = [
+        TOOL_PREFIX_MAP.get(stype, "") + prefix
+        for stype, meta in MCP_TYPE_META.items()
+        for prefix in meta.tool_prefixes_write
+    ]
+    assert write_tools
+    assert not [name for name in write_tools if name.startswith(READ_TOOL_PREFIXES)]
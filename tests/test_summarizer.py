@@ -0,0 +1,124 @@
+"""Тесты сжатия истории: сохранение и переиспользование резюме."""
+
+import asyncio
+from types import SimpleNamespace
+
+from src.agent import summarizer
+from src.agent.batch_summarizer import BatchSummarizer
+from src.agent.context import SUMMARY_PREFIX, build_messages_from_history
+from src.db.database import Database
+from src.db.queries import get_conversation_turns, save_message
+
+
+class _FakeMessages:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.batches = _FakeBatches()
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        return SimpleNamespace(content=[SimpleNamespace(text="- резюме haiku")])
+
+
+class _FakeBatches:
+    def __init__(self) -> None:
+        self.requests: list[dict] = []
+
+    async def create(self, requests):
+        self.requests = requests
+        return SimpleNamespace(id="batch-1")
+
+    async def retrieve(self, batch_id):
+        return SimpleNamespace(processing_status="ended")
+
+    async def results(self, batch_id):
+        async def items():
+            for req in self.requests:
+                message = SimpleNamespace(content=[SimpleNamespace(text="- резюме batch")])
+                yield SimpleNamespace(
+                    custom_id=req["custom_id"],
+                    result=SimpleNamespace(type="succeeded", message=message),
+                )
+        return items()
+
+
+async def _db_with_history(tmp_path, count: int) -> Database:
+    db = Database(str(tmp_path / "agent.db"))
+    await db.connect()
+    await _add_messages(db, count)
+    return db
+
+
+async def _add_messages(db: Database, count: int) -> None:
+    for i in range(count):
+        await save_message(db, "p", "user" if i % 2 == 0 else "assistant", "x" * 600)
+
+
+async def _history(db: Database) -> list[dict]:
+    return build_messages_from_history(await get_conversation_turns(db, "p"))
+
+
+async def _drain_persist_tasks() -> None:
+    if summarizer._persist_tasks:
+        await asyncio.gather(*summarizer._persist_tasks)
+
+
+def test_haiku_summary_is_reused_until_refresh(tmp_path):
+    async def scenario():
+        db = await _db_with_history(tmp_path, 30)
+        client = SimpleNamespace(messages=_FakeMessages())
+        try:
+            first = await summarizer.maybe_summarize(client, db, "p", await _history(db))
+            await _drain_persist_tasks()
+            assert client.messages.calls == 1
+            assert first[0]["content"].startswith(SUMMARY_PREFIX)
+            assert len(first) == 1 + 1 + summarizer.KEEP_RECENT
+
+            # Несколько новых сообщений — резюме из БД, все сообщения после него дословно
+            await _add_messages(db, 4)
+            second = await summarizer.maybe_summarize(client, db, "p", await _history(db))
+            assert client.messages.calls == 1
+            assert "резюме haiku" in second[0]["content"]
+            assert len(second) == 1 + 1 + summarizer.KEEP_RECENT + 4
+
+            # Накопилось больше порога — резюме пересчитывается
+            await _add_messages(db, summarizer.SUMMARY_REFRESH_MESSAGES)
+            await summarizer.maybe_summarize(client, db, "p", await _history(db))
+            await _drain_persist_tasks()
+            assert client.messages.calls == 2
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+
+
+def test_batch_summary_is_saved_with_end_id_and_reused(tmp_path):
+    async def scenario():
+        db = await _db_with_history(tmp_path, 30)
+        client = SimpleNamespace(messages=_FakeMessages())
+        batch = BatchSummarizer(lambda: client, db)
+        try:
+            pending = await summarizer.maybe_summarize(
+                client, db, "p", await _history(db), batch,
+            )
+            # Пока batch не готов — шаблонное резюме, Haiku синхронно не вызывается
+            assert client.messages.calls == 0
+            assert "сообщений" in pending[0]["content"]
+
+            await batch._submit_queued()
+            await batch._collect_finished()
+            row = await db.fetchone(
+                "SELECT messages_end_id FROM conversation_summaries WHERE project_id = 'p'",
+            )
+            assert row["messages_end_id"] > 0
+
+            await _add_messages(db, 2)
+            reused = await summarizer.maybe_summarize(
+                client, db, "p", await _history(db), batch,
+            )
+            assert "резюме batch" in reused[0]["content"]
+            assert await db.fetchone("SELECT 1 FROM summary_jobs") is None
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())